@@ -1,4 +1,4 @@
 from .core import Parameter, Task, notify_completion, run
-from .gce import GPU
+from .gce import GPU, DataDisk
 
-__all__ = ['Task', 'Parameter', 'run', 'notify_completion', 'GPU']
+__all__ = ['Task', 'Parameter', 'run', 'notify_completion', 'GPU', 'DataDisk']
@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import re
+import time
+
+from . import gce
+
+logger = logging.getLogger(__name__)
+
+# GPUをアタッチできるマシンファミリー
+_GPU_MACHINE_FAMILIES = ('n1',)
+
+
+class ComputeSource:
+    """Compute APIからゾーンごとのマシンタイプ、GPUタイプ、CPUプラットフォームを取得するソース.
+
+    fetch()は {ゾーン: {'machine_types': {名前: {'cpus', 'memory_mb'}}, 'accelerators': {名前: 最大枚数},
+    'cpu_platforms': [名前]}} を返す。同じ形式を返すオブジェクトであればCatalogのソースにできる。
+    """
+
+    def fetch(self, project):
+        """ゾーンごとの情報を取得する."""
+        service = gce._service()
+        zones = {}
+        for item in _list(service.zones(), project):
+            zones[item['name']] = {
+                'machine_types': {},
+                'accelerators': {},
+                'cpu_platforms': item.get('availableCpuPlatforms', []),
+            }
+        for zone, item in _aggregated_list(service.machineTypes(), project, 'machineTypes'):
+            zones.setdefault(zone, _empty())['machine_types'][item['name']] = {
+                'cpus': item['guestCpus'],
+                'memory_mb': item['memoryMb'],
+            }
+        for zone, item in _aggregated_list(service.acceleratorTypes(), project, 'acceleratorTypes'):
+            zones.setdefault(zone, _empty())['accelerators'][item['name']] = \
+                item.get('maximumCardsPerInstance', 0)
+        return zones
+
+
+class StaticSource:
+    """与えられた内容をそのまま返すソース. オフラインでのテストなどに使う."""
+
+    def __init__(self, zones):  # noqa: D107
+        self.zones = zones
+
+    def fetch(self, project):
+        """ゾーンの情報を返す."""
+        return self.zones
+
+
+class Catalog:
+    """ゾーンごとに利用できるマシンタイプ、GPUタイプ、CPUプラットフォームのカタログ.
+
+    プロジェクトごとに1度だけ取得し、cache_dirにttl秒間キャッシュする。
+    """
+
+    def __init__(self,
+                 source=None,
+                 cache_dir=None,
+                 ttl=24 * 60 * 60):  # noqa: D107
+        self.source = source or ComputeSource()
+        self.cache_dir = cache_dir or os.path.join(
+            os.path.expanduser('~'), '.cache', 'gce_task_runner')
+        self.ttl = ttl
+        self._zones = {}
+
+    def zones(self, project):
+        """プロジェクトのゾーンごとの情報を取得する."""
+        if project not in self._zones:
+            zones = self._load(project)
+            if zones is None:
+                zones = self.source.fetch(project)
+                self._save(project, zones)
+            self._zones[project] = zones
+        return self._zones[project]
+
+    def resources(self, project, parameter):
+        """インスタンス1台あたりの(vCPU数, GPU数)を取得する. 不明な場合のvCPU数はNone."""
+        gpus = parameter.gpu_info[0] if parameter.gpu_info else 0
+        custom = _parse_custom(parameter.machine_type)
+        if custom:
+            return custom[0], gpus
+        zone = self.zones(project).get(parameter.zone, _empty())
+        machine_type = zone['machine_types'].get(parameter.machine_type)
+        return (machine_type['cpus'] if machine_type else None), gpus
+
+    def validate(self, project, parameter):
+        """パラメータの問題点の一覧を返す."""
+        zones = self.zones(project)
+        if parameter.zone not in zones:
+            return ['zone {} is not available'.format(parameter.zone)]
+        zone = zones[parameter.zone]
+        errors = []
+        if not _parse_custom(parameter.machine_type) \
+                and parameter.machine_type not in zone['machine_types']:
+            errors.append('machine type {} is not available in {}'.format(
+                parameter.machine_type, parameter.zone))
+        if parameter.gpu_info:
+            num, gpu = parameter.gpu_info
+            if gpu.value not in zone['accelerators']:
+                errors.append('{} is not available in {}'.format(gpu.value, parameter.zone))
+            elif num > zone['accelerators'][gpu.value]:
+                errors.append('{} supports up to {} per instance'.format(
+                    gpu.value, zone['accelerators'][gpu.value]))
+            family = 'n1' if parameter.machine_type.startswith('custom-') \
+                else parameter.machine_type.split('-')[0]
+            if family not in _GPU_MACHINE_FAMILIES:
+                errors.append('GPUs cannot be attached to {}'.format(parameter.machine_type))
+        if parameter.minCpuPlatform and parameter.minCpuPlatform != 'Automatic' \
+                and parameter.minCpuPlatform not in zone['cpu_platforms']:
+            errors.append('{} is not available in {}'.format(
+                parameter.minCpuPlatform, parameter.zone))
+        return errors
+
+    def _path(self, project):
+        return os.path.join(self.cache_dir, '{}.json'.format(project))
+
+    def _load(self, project):
+        try:
+            with open(self._path(project)) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cache.get('fetched_at', 0) + self.ttl < time.time():
+            return None
+        return cache['zones']
+
+    def _save(self, project, zones):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._path(project), 'w') as f:
+                json.dump({'fetched_at': time.time(), 'zones': zones}, f)
+        except OSError as e:
+            logger.warning('catalog is not cached: {}'.format(e))
+
+
+def _empty():
+    return {'machine_types': {}, 'accelerators': {}, 'cpu_platforms': []}
+
+
+def _parse_custom(machine_type):
+    """カスタムマシンタイプの(vCPU数, メモリMB)を返す. カスタムでなければNone."""
+    match = re.match(r'^(?:[a-z0-9]+-)?custom-(\d+)-(\d+)', machine_type)
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def _list(resource, project):
+    request = resource.list(project=project)
+    while request is not None:
+        response = gce._execute(request, project)
+        yield from response.get('items', [])
+        request = resource.list_next(request, response)
+
+
+def _aggregated_list(resource, project, key):
+    request = resource.aggregatedList(project=project)
+    while request is not None:
+        response = gce._execute(request, project)
+        for scope, items in response.get('items', {}).items():
+            # scopeは zones/<ゾーン名>
+            zone = scope.split('/')[-1]
+            for item in items.get(key, []):
+                yield zone, item
+        request = resource.aggregatedList_next(request, response)
@@ -1,13 +1,18 @@
+import asyncio
 import logging
 import threading
 import time
 import uuid
-from functools import partial
+from collections.abc import Sequence
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from functools import partial, reduce
+from math import gcd
 
 import requests
 from asynconsumer import async_run
 
-from . import gce, pubsub, store
+from . import catalog, gce, pubsub, serial, store, trace
 
 logging.captureWarnings(True)
 logger = logging.getLogger(__name__)
@@ -15,6 +20,21 @@ logger = logging.getLogger(__name__)
 # GCEインスタンスから通知されたエラー
 _ERRORS = []
 _IS_TASK_COMPLETED = False
+# fail_fastのタスクでエラーが発生した
+_IS_TASK_CANCELLED = threading.Event()
+# インスタンスのライフサイクルの記録
+_RECORDER = None
+
+# インスタンスの削除は次のタスクの開始を待たせないようにバックグラウンドで行う
+_DELETER = ThreadPoolExecutor(max_workers=100)
+_DELETIONS = set()
+_DELETIONS_LOCK = threading.Lock()
+# QUOTAエラー時にリトライするまでの秒数
+_QUOTA_RETRY_INTERVAL = 30
+# タスク間で共有する入力データディスク. {(プロジェクト, ゾーン, ディスク名): [Disk, 使用中のタスク数]}
+# 前のタスクの削除と次のタスクの作成が重ならないように、作成と削除はロック内で行う
+_DISKS = {}
+_DISKS_LOCK = threading.Lock()
 
 
 class Task:
@@ -25,12 +45,78 @@ class Task:
                  project,
                  parameter,
                  timeout=0,
-                 retry_quota_exceeded=False):  # noqa: D107
+                 retry_quota_exceeded=False,
+                 collect_serial_log=False,
+                 serial_log_dir=None,
+                 speculative_ratio=None,
+                 flow_control=None,
+                 show_progress=False,
+                 fail_fast=False,
+                 create_concurrency=100):  # noqa: D107
         self.name = name
-        self.project = project
+        # 複数のプロジェクトを指定した場合は重み(整数)に応じてインスタンスを振り分ける
+        # 完了通知は最初のプロジェクトのトピックに集める
+        self.shards = _normalize_projects(project)
+        self.project = self.shards[0][0]
         self.parameter = parameter
         self.timeout = timeout
         self.retry_quota_exceeded = retry_quota_exceeded
+        # serial_log_dirを指定しない場合はloggingに出力する
+        self.collect_serial_log = collect_serial_log or bool(serial_log_dir)
+        self.serial_log_dir = serial_log_dir
+        # 完了した割合がこの値を超えたら、残りのインスタンスの複製を起動して早く終わった方を採用する
+        self.speculative_ratio = speculative_ratio
+        # 完了通知の受信数の上限. pubsub.types.FlowControlの引数(max_messages, max_bytesなど)
+        self.flow_control = flow_control
+        self.show_progress = show_progress
+        # Trueの場合は最初のエラーで残りのインスタンスを全て削除してすぐに終了する
+        self.fail_fast = fail_fast
+        # インスタンスを並列で作成する数
+        self.create_concurrency = create_concurrency
+        # fail_fastで削除したインスタンス名
+        self.cancelled_instances = []
+        self._cycle = None
+
+    @property
+    def projects(self):
+        """インスタンスを作成するプロジェクトの一覧."""
+        return [project for project, _ in self.shards]
+
+    def project_for(self, num):
+        """num番目のインスタンスを作成するプロジェクト."""
+        if len(self.shards) == 1:
+            return self.project
+        if self._cycle is None:
+            self._cycle = _weighted_cycle(self.shards)
+        return self._cycle[num % len(self._cycle)]
+
+
+def _normalize_projects(project):
+    """プロジェクトの指定を[(プロジェクト, 重み)]に変換する"""
+    if isinstance(project, str):
+        return [(project, 1)]
+    if isinstance(project, dict):
+        shards = list(project.items())
+    else:
+        shards = [(p, 1) for p in project]
+    if not shards or any(not isinstance(w, int) or w <= 0 for _, w in shards):
+        raise ValueError('Set projects with positive integer weights')
+    return shards
+
+
+def _weighted_cycle(shards):
+    """重みに応じてプロジェクトをなるべく均等に並べた1周期分のリスト(smooth weighted round-robin)"""
+    divisor = reduce(gcd, [w for _, w in shards])
+    weights = [w // divisor for _, w in shards]
+    total = sum(weights)
+    current = [0] * len(shards)
+    cycle = []
+    for _ in range(total):
+        current = [c + w for c, w in zip(current, weights)]
+        i = current.index(max(current))
+        current[i] -= total
+        cycle.append(shards[i][0])
+    return cycle
 
 
 class Parameter:
@@ -51,7 +137,8 @@ class Parameter:
                  gpu_info=None,
                  minCpuPlatform=None,
                  preemptible=False,
-                 labels=None):  # noqa: D107
+                 labels=None,
+                 data_disks=None):  # noqa: D107
 
         if len(list(filter(lambda x: bool(x), (startup_script, startup_script_url)))) != 1:
             raise ValueError('Set only one of startup_script and startup_script_url')
@@ -66,11 +153,34 @@ class Parameter:
         self.machine_type = machine_type
         self.zone = zone
         self.disk_size = disk_size
-        self.metas = metas or [[{}] for _ in range(instances)]
+        # リスト、通し番号を引数にとる関数、または順に消費されるイテラブル
+        self.metas = metas
         self.gpu_info = gpu_info
         self.minCpuPlatform = minCpuPlatform
         self.preemptible = preemptible
         self.labels = labels or {}
+        self.data_disks = data_disks or []
+
+    def get_metas(self, num):
+        """num番目のインスタンスのメタデータを取得する."""
+        if self.metas is None:
+            return [{}]
+        if callable(self.metas):
+            return self.metas(num)
+        return self.metas[num]
+
+    def iter_metas(self):
+        """(通し番号, メタデータ)を順に生成する. イテラブルの場合は必要になった分だけ消費する."""
+        if self.metas is None or callable(self.metas) or isinstance(self.metas, Sequence):
+            for num in range(self.instances):
+                yield num, self.get_metas(num)
+            return
+        metas = iter(self.metas)
+        for num in range(self.instances):
+            try:
+                yield num, next(metas)
+            except StopIteration:
+                raise ValueError('metas has fewer items than instances')
 
 
 def notify_completion(project=None, topic=None, error=None):
@@ -80,12 +190,17 @@ def notify_completion(project=None, topic=None, error=None):
         topic = topic or _get_metadata('topic')
         _id = _get_metadata('instance-id')
         if topic and _id:
+            # マネージャーが通知を実行中のタスクに振り分けるための属性
+            attributes = {
+                'run_id': _get_metadata('run-id'),
+                'task_id': _get_metadata('task-id'),
+            }
+            if error:
+                attributes['error'] = str(error)
+            attributes = {k: v for k, v in attributes.items() if v}
             publisher = pubsub.PublishClient(project)
             try:
-                if error:
-                    publisher.publish(topic, _id, error=str(error))
-                else:
-                    publisher.publish(topic, _id)
+                publisher.publish(topic, _id, **attributes)
                 logger.info('notify_completion: {}'.format(_id))
             except Exception as e:
                 logger.info('notify_completion is not completed: {}'.format(e))
@@ -96,8 +211,16 @@ def notify_completion(project=None, topic=None, error=None):
         logger.info('notify_completion is not sent.')
 
 
-def run(tasks, topic='manager', subscription='manager', project=None):
-    """タスクリストを実行する."""
+def run(tasks, topic='manager', subscription='manager', project=None, zone_catalog=None,
+        trace_path=None):
+    """タスクリストを実行する.
+
+    インスタンスを作成する前に全タスクのパラメータをzone_catalogで検証し、問題があればValueErrorにする。
+    trace_pathを指定するとインスタンスのライフサイクルをJSON Linesで追記する。
+    エラーがあればそのタスク名とエラーのリストを返す。
+    fail_fastのタスクで中断した場合はインスタンスの削除完了を待たずに返し、
+    削除したインスタンス名はtask.cancelled_instancesに入る。
+    """
     if topic != 'manager' or subscription != 'manager' or project:
         # TODO: 2.0.0でtask以外の引数を消す
         import warnings
@@ -105,11 +228,136 @@ def run(tasks, topic='manager', subscription='manager', project=None):
                        " These do not work now."
                        ), DeprecationWarning)
 
+    global _RECORDER
+    tasks = list(tasks)
+    _validate(tasks, zone_catalog or catalog.Catalog())
+
+    channels = _Channels()
+    if trace_path:
+        _RECORDER = trace.Recorder(trace_path)
+    _trace('run_start', run_id=channels.run_id)
+    try:
+        for task in tasks:
+            error = _run_task(task, channels)
+            if error:
+                return task.name, error
+        return None
+    finally:
+        cancelled = _IS_TASK_CANCELLED.is_set()
+        if not cancelled:
+            # 直前のタスクのインスタンス削除の完了を待つ
+            _wait_for_deletions()
+        channels.close()
+        _trace('run_end', run_id=channels.run_id)
+        if _RECORDER:
+            if cancelled:
+                # 中断したタスクのインスタンスの削除を記録し終えてから閉じる
+                threading.Thread(target=_close_recorder, args=(_RECORDER,)).start()
+            else:
+                _close_recorder(_RECORDER)
+
+
+def _trace(event, **fields):
+    """トレースを記録する"""
+    recorder = _RECORDER
+    if recorder:
+        recorder.record(event, **fields)
+
+
+def _close_recorder(recorder):
+    """バックグラウンドの削除処理が全て終わってからトレースのファイルを閉じる"""
+    global _RECORDER
+    _wait_for_deletions()
+    if _RECORDER is recorder:
+        _RECORDER = None
+    recorder.close()
+
+
+def _validate(tasks, zone_catalog):
+    """インスタンスを作成する前に全タスクのパラメータを検証する"""
+    errors = []
     for task in tasks:
-        error = _run_task(task)
-        if error:
-            return task.name, error
-    return None
+        for project in task.projects:
+            try:
+                problems = zone_catalog.validate(project, task.parameter)
+            except Exception as e:
+                # カタログを取得できない場合は検証せずに実行する
+                logger.warning('{} in {} is not validated: {}'.format(task.name, project, e))
+                continue
+            errors.extend('{}: {}: {}'.format(task.name, project, problem) for problem in problems)
+    if errors:
+        raise ValueError('\n'.join(errors))
+
+
+class _Channels:
+    """run()の間、プロジェクトごとに1つのトピックとサブスクリプションを使い回す.
+
+    トピック名とサブスクリプション名は実行ごとに一意なので、複数のマネージャーを同時に実行できる。
+    """
+
+    def __init__(self):  # noqa: D107
+        self.run_id = str(uuid.uuid4())
+        self._stack = ExitStack()
+        self._subscribers = {}
+        self._publishers = set()
+
+    @property
+    def name(self):
+        """トピック名兼サブスクリプション名."""
+        return f'manager-{self.run_id}'
+
+    def route(self, project):
+        """タスク用の経路を取得する. トピックとサブスクリプションは初回のみ作成する."""
+        if project not in self._subscribers:
+            self._subscribers[project] = self._stack.enter_context(
+                pubsub.context(project, self.name, self.name))
+        return _Route(project, self.name, self._subscribers[project], self.run_id)
+
+    def allow_publish(self, project, instance_project):
+        """別のプロジェクトのインスタンスのデフォルトサービスアカウントにトピックへの発行を許可する."""
+        if project == instance_project or (project, instance_project) in self._publishers:
+            return
+        try:
+            account = gce.get_default_service_account(instance_project)
+            pubsub.PublishClient(project).add_publishers(
+                self.name, ['serviceAccount:{}'.format(account)])
+        except Exception as e:
+            # 事前に権限を付与してあれば通知は届く
+            logger.warning('publisher is not added: {}'.format(e))
+        self._publishers.add((project, instance_project))
+
+    def close(self):
+        """トピックとサブスクリプションを削除する."""
+        self._stack.close()
+
+
+class _Route:
+    """1つのタスクの完了通知の経路."""
+
+    def __init__(self, project, topic, subscriber, run_id):  # noqa: D107
+        self.project = project
+        self.topic = topic
+        self.subscription = topic
+        self.subscriber = subscriber
+        self.run_id = run_id
+        self.task_id = str(uuid.uuid4())
+
+    def metas(self, project):
+        """projectに作成するインスタンスに渡すメタデータ."""
+        # 別のプロジェクトのインスタンスにはトピックのフルパスを渡す
+        topic = self.topic if project == self.project else \
+            'projects/{}/topics/{}'.format(self.project, self.topic)
+        return [
+            {'key': 'topic', 'value': topic},
+            {'key': 'run-id', 'value': self.run_id},
+            {'key': 'task-id', 'value': self.task_id},
+        ]
+
+    def is_stale(self, message):
+        """別の実行や前のタスクからの通知かどうか"""
+        attributes = message.attributes
+        return (attributes.get('run_id', self.run_id) != self.run_id
+                or attributes.get('task_id', self.task_id) != self.task_id)
 
 
 def _get_metadata(key):
@@ -138,52 +386,177 @@ def _get_project():
     return None
 
 
-def _run_task(task):
+def _run_task(task, channels):
     """個別のタスクを実行する"""
     global _IS_TASK_COMPLETED
     logger.info('start to {}'.format(task.name))
+    route = channels.route(task.project)
+    for project in task.projects:
+        channels.allow_publish(task.project, project)
+    _IS_TASK_CANCELLED.clear()
     store.initialize(task.parameter.instances)
-
-    # インスタンス作成中でも完了通知を受信できるようにしておく
-    topic = _subscribe_in_background(task)
-
-    # 100台ずつ並列でインスタンスの作成
-    async_run(range(task.parameter.instances), partial(_create_instance, task, topic),
-              concurrency=100, sleep=0)
-
-    # 全台処理が終了するまで待機
-    while not _IS_TASK_COMPLETED:
-        time.sleep(5)
+    _trace('task_start', task=task.name, instances=task.parameter.instances,
+           create_concurrency=task.create_concurrency)
+
+    # 入力データディスクはインスタンス作成前にゾーンごとに1つだけ作成する
+    disks = _create_data_disks(task)
+    deletions = []
+    collector = None
+    if task.collect_serial_log:
+        collector = serial.SerialLogCollector(task.serial_log_dir)
+        collector.start()
+    try:
+        # インスタンス作成中でも完了通知を受信できるようにしておく
+        _subscribe_in_background(task, route, deletions, collector)
+
+        # create_concurrency台ずつ並列でインスタンスの作成
+        _async_run(task.parameter.iter_metas(),
+                   partial(_create_instance, task, route, disks, deletions),
+                   task.create_concurrency)
+
+        # 全台の完了通知を受信するまで待機. 削除の完了は待たない
+        speculated = False
+        while not _IS_TASK_COMPLETED:
+            time.sleep(1)
+            if not speculated and not _IS_TASK_CANCELLED.is_set() and _should_speculate(task):
+                speculated = True
+                _create_backup_instances(task, route, disks, deletions)
+        if speculated:
+            logger.info('speculations: {}'.format(store.get_speculations()))
+    finally:
+        if collector:
+            collector.stop()
+        if disks:
+            _submit_deletion(_delete_data_disks, disks, deletions)
 
     logger.info('finish to {}'.format(task.name))
+    _trace('task_end', task=task.name)
+    logger.info('compute api rate limits: {}'.format(
+        {project: gce.get_rate_limit_stats(project) for project in task.projects}))
     _IS_TASK_COMPLETED = False
     return _ERRORS
 
 
-def _subscribe_in_background(task):
+def _submit_deletion(fn, *args):
+    """削除処理をバックグラウンドで実行する"""
+    future = _DELETER.submit(fn, *args)
+    with _DELETIONS_LOCK:
+        _DELETIONS.add(future)
+
+    def _done(f):
+        with _DELETIONS_LOCK:
+            _DELETIONS.discard(f)
+        if f.exception():
+            logger.warning('deletion failed: {}'.format(f.exception()))
+
+    future.add_done_callback(_done)
+    return future
+
+
+def _has_pending_deletions():
+    with _DELETIONS_LOCK:
+        return bool(_DELETIONS)
+
+
+def _wait_for_deletions():
+    """バックグラウンドで実行中の削除処理が全て終わるまで待機する"""
+    while True:
+        with _DELETIONS_LOCK:
+            futures = list(_DELETIONS)
+        if not futures:
+            return
+        wait(futures)
+
+
+def _wait_for_any_deletion():
+    """実行中の削除処理のいずれかが終わるか、タスクが中断されるまで待機する"""
+    with _DELETIONS_LOCK:
+        futures = list(_DELETIONS)
+    while futures and not _IS_TASK_CANCELLED.is_set():
+        done, _ = wait(futures, timeout=0.5, return_when=FIRST_COMPLETED)
+        if done:
+            return
+
+
+def _delete_instance(instance_id, instance, collector=None, timed_out=False):
+    """GCEインスタンスを削除する"""
+    # 削除するとシリアルポート出力も消えるので先に取得しておく
+    if collector:
+        collector.capture(instance_id, instance)
+    if timed_out and _RECORDER:
+        # 時間切れの原因がプリエンプションかどうかを記録する
+        try:
+            if instance.get_status() in ('STOPPING', 'STOPPED', 'TERMINATED'):
+                _trace('preempted', instance_id=instance_id)
+        except Exception:
+            pass
+    started = time.time()
+    instance.delete()
+    _trace('deleted', instance_id=instance_id, latency=time.time() - started)
+    logger.info('instance {} is terminated'.format(instance_id))
+
+
+def _delete_data_disks(disks, deletions):
+    """タスクのインスタンスが全て削除されてから入力データディスクを手放す"""
+    wait(deletions)
+    _release_data_disks(disks)
+
+
+def _release_data_disks(disks):
+    """入力データディスクを手放し、他に使用中のタスクがなければ削除する"""
+    with _DISKS_LOCK:
+        for disk in disks:
+            key = _disk_key(disk)
+            _DISKS[key][1] -= 1
+            if _DISKS[key][1] > 0:
+                continue
+            del _DISKS[key]
+            disk.delete()
+            logger.info('disk {} is deleted'.format(disk.data_disk.name))
+
+
+def _subscribe_in_background(task, route, deletions, collector=None):
     """バックグラウンドスレッドでGCEインスタンスからの完了通知を受け取る"""
-    project = task.project
-    topic = f"task-{task.name.replace(' ', '-')}-{str(uuid.uuid4())}"
-    subscription = f"task-{task.name.replace(' ', '-')}"
-
-    def callback(message):
-        # インスタンスからの完了通知を受け取った時の処理
-        instance_id = message.data.decode('utf-8')
-        instance, _ = store.pop(instance_id)
-        if instance:
-            if 'error' in message.attributes:
+
+    def callback(messages):
+        # インスタンスからの完了通知をまとめて処理する
+        attributes = {}
+        for message in messages:
+            instance_id = message.data.decode('utf-8')
+            if route.is_stale(message):
+                # 前のタスクの重複した通知などは捨てる
+                logger.debug('stale message from {} is ignored'.format(instance_id))
+                continue
+            attributes[instance_id] = message.attributes
+
+        completed = 0
+        for instance_id, (instance, _), siblings in store.pop_completions(list(attributes)):
+            if instance:
+                _trace('completed', task=task.name, instance_id=instance_id,
+                       error='error' in attributes[instance_id])
+            # 投機実行で複製されたインスタンスは先に完了した方を採用して残りは削除する
+            for _id, (sibling, _) in siblings:
+                logger.info('instance {} is cancelled by {}'.format(_id, instance_id))
+                deletions.append(_submit_deletion(_delete_instance, _id, sibling, collector))
+            if not instance:
+                continue
+            if 'error' in attributes[instance_id]:
                 # errorメッセージが含まれていたらエラーとして処理する、それ以外は正常終了扱い
-                error_msg = message.attributes['error']
+                error_msg = attributes[instance_id]['error']
                 logger.info(
                     'Error occurred while executing the task({}) in {}: {}'.format(
                         task.name, instance_id, error_msg))
                 _ERRORS.append(f'{error_msg} found in {instance_id}')
+                if task.fail_fast:
+                    _cancel(task, deletions, collector)
             else:
-                logger.info('instance {} is completed'.format(instance_id))
+                logger.debug('instance {} is completed'.format(instance_id))
+                completed += 1
 
             # インスタンスの削除
-            instance.delete()
-            logger.info('instance {} is terminated'.format(instance_id))
+            deletions.append(_submit_deletion(_delete_instance, instance_id, instance, collector))
+        if completed:
+            logger.info('{} instances are completed'.format(completed))
 
     def stop_callback():
         # Trueを返すとPubSubの監視を終了する
@@ -191,48 +564,143 @@ def _subscribe_in_background(task):
             # 時間切れのインスタンスを削除
             for _id, (instance, _) in store.get_time_overs():
                 logger.info('instance {} is timeout!!!'.format(_id))
-                instance.delete()
-                logger.info('instance {} is terminated'.format(_id))
+                _trace('timeout', task=task.name, instance_id=_id)
+                deletions.append(
+                    _submit_deletion(_delete_instance, _id, instance, collector, True))
         return store.get_remains_count() == 0
 
+    progress = _progress_reporter(task) if task.show_progress else None
     thread = threading.Thread(target=_subscribe,
-                              args=(project, topic, subscription, callback, stop_callback))
+                              args=(route, callback, stop_callback, task.flow_control, progress))
     thread.start()
-    return topic
 
 
-def _subscribe(project, topic, subscription, callback, stop_callback):
+def _subscribe(route, callback, stop_callback, flow_control=None, progress=None):
     """サブスクライブの実行"""
     global _IS_TASK_COMPLETED
-    with pubsub.context(project, topic, subscription) as subscriber:
-        subscriber.subscribe(subscription, callback, stop_callback)
+    route.subscriber.subscribe(route.subscription, callback, stop_callback,
+                               flow_control=flow_control, progress=progress)
     _IS_TASK_COMPLETED = True
 
 
-def _create_instance(task, topic, num):
+def _cancel(task, deletions, collector=None):
+    """作成待ちのインスタンスの作成を止めて、実行中のインスタンスを全て削除する"""
+    if _IS_TASK_CANCELLED.is_set():
+        return
+    _IS_TASK_CANCELLED.set()
+    instances = store.pop_all()
+    logger.info('cancel {} instances of {}'.format(len(instances), task.name))
+    for _id, (instance, _) in instances:
+        task.cancelled_instances.append(instance.instance)
+        deletions.append(_submit_deletion(_delete_instance, _id, instance, collector))
+
+
+def _progress_reporter(task, interval=30):
+    """残りのインスタンス数を定期的にログに出力する関数を返す"""
+    last = [0]
+
+    def progress():
+        now = time.time()
+        if now - last[0] >= interval:
+            last[0] = now
+            logger.info('{}: {}/{} instances remain'.format(
+                task.name, store.get_remains_count(), task.parameter.instances))
+
+    return progress
+
+
+def _create_data_disks(task):
+    """タスクの入力データディスクを作成する. 前のタスクが使用中の同じディスクはそのまま使う"""
+    param = task.parameter
+    disks = []
+    try:
+        with _DISKS_LOCK:
+            for project in task.projects:
+                for data_disk in param.data_disks:
+                    key = (project, param.zone, data_disk.name)
+                    if key not in _DISKS:
+                        disk = gce.Disk(data_disk, project, param.zone)
+                        disk.create()
+                        logger.info('disk {} is created in {}'.format(data_disk.name, project))
+                        _DISKS[key] = [disk, 0]
+                    _DISKS[key][1] += 1
+                    disks.append(_DISKS[key][0])
+    except Exception:
+        # 途中で失敗した場合は作成済みのディスクを片付ける
+        _release_data_disks(disks)
+        raise
+    return disks
+
+
+def _disk_key(disk):
+    return disk.project, disk.zone, disk.data_disk.name
+
+
+def _should_speculate(task):
+    """投機実行を開始するかどうか"""
+    if not task.speculative_ratio:
+        return False
+    instances = task.parameter.instances
+    return instances - store.get_remains_count() >= instances * task.speculative_ratio
+
+
+def _create_backup_instances(task, route, disks, deletions):
+    """実行中のインスタンスの複製を作成する"""
+    targets = [(num, instance.extra_metas) for num, instance in store.get_unspeculated()]
+    logger.info('start speculative execution of {} instances'.format(len(targets)))
+    _async_run(targets, partial(_create_instance, task, route, disks, deletions, backup=True),
+               task.create_concurrency)
+
+
+def _async_run(targets, fn, concurrency):
+    """concurrency並列でfnを実行する
+
+    async_runはイベントループのデフォルトのスレッドプール(最大32スレッド)で関数を実行するので、
+    concurrencyに合わせたスレッドプールを持つイベントループで実行する
+    """
+    previous = asyncio.get_event_loop_policy().get_event_loop()
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    asyncio.set_event_loop(loop)
+    try:
+        return async_run(targets, fn, concurrency=concurrency, sleep=0)
+    finally:
+        asyncio.set_event_loop(previous)
+        loop.close()
+
+
+def _create_instance(task, route, disks, deletions, target, backup=False):
     """GCEインスタンスを作成する
 
     task.retry_quota_exceeded がTrueの場合はQUOTAエラー時はリトライする
     :param task: タスク
-    :param topic: GCEインスタンスが完了通知を飛ばすトピック
-    :param num: タスク内でのそのインスタンスの通し番号
+    :param route: GCEインスタンスが完了通知を飛ばす経路
+    :param disks: 読み取り専用でアタッチするデータディスク
+    :param deletions: 不要になったインスタンスの削除処理を追加するリスト
+    :param target: タスク内でのそのインスタンスの通し番号とメタデータ
+    :param backup: 投機実行のための複製かどうか
     """
+    num, extra_metas = target
+    if _IS_TASK_CANCELLED.is_set() or (backup and store.is_resolved(num)):
+        return
     param = task.parameter
+    project = task.project_for(num)
+    name = param.instance_name.format(num)
+    if backup:
+        name += '-spec'
+
     _id = str(uuid.uuid4())
     metas = [
                 {'key': 'instance-id', 'value': _id},
                 {'key': 'instance-number', 'value': num},
-                {'key': 'topic', 'value': topic},
-            ] + param.metas[num]
-    # googleapiclientがImportErrorをたくさん出すので抑制
-    logging.disable(logging.FATAL)
+            ] + route.metas(project) + extra_metas
     instance = gce.Client(
-        param.instance_name.format(num),
+        name,
         param.startup_script,
         param.startup_script_url,
         param.shutdown_script,
         param.shutdown_script_url,
-        task.project,
+        project,
         zone=param.zone,
         machine_type=param.machine_type,
         image=param.image,
@@ -242,21 +710,48 @@ def _create_instance(task, topic, num):
         minCpuPlatform=param.minCpuPlatform,
         preemptible=param.preemptible,
         labels=param.labels,
+        data_disks=[disk for disk in disks if disk.project == project],
     )
-    logging.disable(logging.NOTSET)
     while True:
+        # 複製はQUOTA待ちの間に元のインスタンスが完了していれば作成しない
+        if _IS_TASK_CANCELLED.is_set() or (backup and store.is_resolved(num)):
+            return
         try:
+            started = time.time()
             instance.create()
-            logger.info(f'{param.instance_name.format(num)}({_id}) is created')
+            logger.info(f'{name}({_id}) is created')
         except Exception as e:
-            if task.retry_quota_exceeded and 'Quota' in str(e) and 'exceeded' in str(e):
+            quota_exceeded = 'Quota' in str(e) and 'exceeded' in str(e)
+            if quota_exceeded and _has_pending_deletions():
+                # インスタンスが削除中でQUOTAが空いていないので、いずれかの削除を待ってリトライする
+                logger.debug('Wait for a deletion because quota exceeded')
+                _wait_for_any_deletion()
+                continue
+            if task.retry_quota_exceeded and quota_exceeded:
                 # リトライする
                 logger.debug('Retry because quota exceeded')
-                time.sleep(30)
+                # 中断されたらすぐに戻る
+                _IS_TASK_CANCELLED.wait(_QUOTA_RETRY_INTERVAL)
                 continue
+            elif backup:
+                # 複製は作成できなくても元のインスタンスの完了を待てばよいのでタスクを止めない
+                logger.warning(f'{name} is not created: {e}')
+                return
             else:
                 # リトライ不要であればエラーにして終了
                 raise
         else:
-            store.register(_id, instance, task.timeout)
+            _trace('created', task=task.name, instance_id=_id, number=num, project=project,
+                   zone=param.zone, machine_type=param.machine_type,
+                   preemptible=param.preemptible, backup=backup,
+                   latency=time.time() - started)
+            # 複製の作成に必要な場合以外はメタデータを保持しない
+            record = instance.to_instance(extra_metas if task.speculative_ratio else None)
+            if not store.register(_id, record, task.timeout, number=num):
+                # 作成中に元のインスタンスが完了した複製やキャンセルされたタスクのインスタンスは不要
+                logger.info(f'{name}({_id}) is no longer needed')
+                if _IS_TASK_CANCELLED.is_set():
+                    task.cancelled_instances.append(name)
+                # 作成スレッドを待たせないようにバックグラウンドで削除する
+                deletions.append(_submit_deletion(_delete_instance, _id, record))
             break
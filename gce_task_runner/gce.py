@@ -1,12 +1,26 @@
 import logging
+import threading
 import time
 from enum import Enum
 
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from . import ratelimit
+
 logger = logging.getLogger(__name__)
 
+_LOCAL = threading.local()
+
+# Compute APIの読み込み/書き込みのレート制限(回/秒). APIの上限はプロジェクトごとなので制限もプロジェクトごとにかける
+# {プロジェクト: {'read': 回/秒, 'write': 回/秒}}. Noneは既定値
+_RATE_LIMITS = {None: {'read': 20, 'write': 10}}
+# {(プロジェクト, 'read' or 'write'): TokenBucket}
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+# レート制限のエラー時の最大リトライ回数
+_MAX_RETRIES = 8
+
 
 class GPU(Enum):
     """GPUタイプのEnum."""
@@ -16,7 +30,99 @@ class GPU(Enum):
     P100 = 'nvidia-tesla-p100'
 
 
-class Client:
+class DataDisk:
+    """全インスタンスに読み取り専用でアタッチする入力データディスクの定義クラス.
+
+    タスク開始時にスナップショットまたはイメージからゾーンに1つだけ作成され、
+    インスタンス内では /dev/disk/by-id/google-<device_name> として参照できる。
+    """
+
+    def __init__(self,
+                 name,
+                 source_snapshot=None,
+                 source_image=None,
+                 disk_type='pd-standard',
+                 size_gb=None,
+                 device_name=None):  # noqa: D107
+        if len(list(filter(lambda x: bool(x), (source_snapshot, source_image)))) != 1:
+            raise ValueError('Set only one of source_snapshot and source_image')
+
+        self.name = name
+        self.source_snapshot = source_snapshot
+        self.source_image = source_image
+        self.disk_type = disk_type
+        self.size_gb = size_gb
+        self.device_name = device_name or name
+
+
+class Instance:
+    """作成済みのGCEインスタンスのクラス.
+
+    削除やシリアルポート出力の取得に必要な情報だけを持ち、大量に保持してもメモリを消費しない。
+    """
+
+    __slots__ = ('instance', 'project', 'zone', 'extra_metas')
+
+    def __init__(self, instance, project, zone, extra_metas=None):  # noqa: D107
+        self.instance = instance
+        self.project = project
+        self.zone = zone
+        # 投機実行で複製を作成する際のメタデータ
+        self.extra_metas = extra_metas
+
+    @property
+    def service(self):
+        """APIクライアント. googleapiclientはスレッドセーフではないのでスレッドごとに作成する."""
+        return _service()
+
+    def delete(self):
+        """インスタンス削除."""
+        try:
+            operation = self.delete_async()
+            return self.wait_for_operation(operation['name'])
+        except Exception:
+            return {'status': "DONE"}
+
+    def delete_async(self):
+        """インスタンス削除(非同期)."""
+        try:
+            return _execute(self.service.instances().delete(
+                project=self.project,
+                zone=self.zone,
+                instance=self.instance
+            ), self.project, write=True)
+        except HttpError as e:
+            if 'HttpError 404' in str(e):
+                logger.info("{} has been deleted".format(self.instance))
+                # すでに存在しない場合は正常時と同じ型のダミーを返す
+                return {'error': str(e)}
+            logger.warning('error: {}'.format(e))
+            raise
+
+    def get_status(self):
+        """インスタンスの状態(RUNNING, TERMINATEDなど)の取得."""
+        return _execute(self.service.instances().get(
+            project=self.project,
+            zone=self.zone,
+            instance=self.instance,
+        ), self.project)['status']
+
+    def get_serial_port_output(self, start=0, port=1):
+        """シリアルポート出力の取得. 次回の取得開始位置は戻り値のnextに入っている."""
+        return _execute(self.service.instances().getSerialPortOutput(
+            project=self.project,
+            zone=self.zone,
+            instance=self.instance,
+            port=port,
+            start=start,
+        ), self.project)
+
+    def wait_for_operation(self, operation):
+        """ジョブの待機. ポーリングによって実現."""
+        return _wait_for_operation(self.service, self.project, self.zone, operation)
+
+
+class Client(Instance):
     """GCEのAPI用のクライアントクラス."""
 
     def __init__(self,
@@ -34,17 +140,15 @@ class Client:
                  gpu_info,
                  minCpuPlatform,
                  preemptible,
-                 labels):  # noqa: D107
-        self.service = build('compute', 'v1')
+                 labels,
+                 data_disks=None):  # noqa: D107
+        super().__init__(instance, project, zone)
         # Required
-        self.instance = instance
         self.startup_script = startup_script
         self.startup_script_url = startup_script_url
         self.shutdown_script = shutdown_script
         self.shutdown_script_url = shutdown_script_url
-        self.project = project
         # Optional
-        self.zone = zone
         self.machine_type = machine_type
         self.image = image
         self.disk_size = disk_size
@@ -54,6 +158,11 @@ class Client:
         self.preemptible = preemptible
         self.region = self.zone[:-2]
         self.labels = labels
+        self.data_disks = data_disks or []
+
+    def to_instance(self, extra_metas=None):
+        """作成済みのインスタンスとして保持するための情報だけを取り出す."""
+        return Instance(self.instance, self.project, self.zone, extra_metas)
 
     def create(self):
         """インスタンス作成."""
@@ -63,38 +172,14 @@ class Client:
     def create_async(self):
         """インスタンス作成(非同期)."""
         try:
-            return self.service.instances().insert(
+            return _execute(self.service.instances().insert(
                 project=self.project,
                 zone=self.zone,
                 body=self.config,
-            ).execute()
+            ), self.project, write=True)
         except HttpError:
             raise
 
-    def delete(self):
-        """インスタンス削除."""
-        try:
-            operation = self.delete_async()
-            return self.wait_for_operation(operation['name'])
-        except Exception:
-            return {'status': "DONE"}
-
-    def delete_async(self):
-        """インスタンス削除(非同期)."""
-        try:
-            return self.service.instances().delete(
-                project=self.project,
-                zone=self.zone,
-                instance=self.instance
-            ).execute()
-        except HttpError as e:
-            if 'HttpError 404' in str(e):
-                logger.info("{} has been deleted".format(self.instance))
-                # すでに存在しない場合は正常時と同じ型のダミーを返す
-                return {'error': str(e)}
-            logger.warning('error: {}'.format(e))
-            raise
-
     @property
     def config(self):
         """APIパラメータ."""
@@ -152,6 +237,14 @@ class Client:
                         "diskSizeGb": self.disk_size,
                     }
                 }
+            ] + [
+                {
+                    "boot": False,
+                    "autoDelete": False,
+                    "mode": "READ_ONLY",
+                    "source": disk.source,
+                    "deviceName": disk.device_name,
+                } for disk in self.data_disks
             ],
             "networkInterfaces": [
                 {
@@ -197,18 +290,166 @@ class Client:
             _config["labels"] = self.labels
         return _config
 
-    def wait_for_operation(self, operation):
-        """ジョブの待機. ポーリングによって実現."""
-        logger.debug(f'Waiting for {operation} to finish...')
-        while True:
-            result = self.service.zoneOperations().get(
+
+class Disk:
+    """データディスクのAPI用のクライアントクラス."""
+
+    def __init__(self, data_disk, project, zone):  # noqa: D107
+        self.data_disk = data_disk
+        self.project = project
+        self.zone = zone
+        # 既存のディスクを再利用した場合は削除しない
+        self.created = False
+
+    @property
+    def service(self):
+        """APIクライアント. タスク間で共有され別のスレッドから削除されるのでスレッドごとのものを使う."""
+        return _service()
+
+    @property
+    def device_name(self):
+        """インスタンス内でのデバイス名."""
+        return self.data_disk.device_name
+
+    @property
+    def source(self):
+        """インスタンスにアタッチする際のディスクのURL."""
+        return "projects/{}/zones/{}/disks/{}".format(self.project, self.zone, self.data_disk.name)
+
+    def create(self):
+        """ディスク作成. すでに存在する場合はそれを利用する."""
+        try:
+            operation = _execute(self.service.disks().insert(
+                project=self.project,
+                zone=self.zone,
+                body=self.config,
+            ), self.project, write=True)
+        except HttpError as e:
+            if 'HttpError 409' in str(e):
+                logger.info("{} already exists".format(self.data_disk.name))
+                return {'status': "DONE"}
+            raise
+        result = _wait_for_operation(self.service, self.project, self.zone, operation['name'])
+        self.created = True
+        return result
+
+    def delete(self):
+        """ディスク削除. 作成していないディスクは削除しない."""
+        if not self.created:
+            return {'status': "DONE"}
+        try:
+            operation = _execute(self.service.disks().delete(
                 project=self.project,
                 zone=self.zone,
-                operation=operation).execute()
-
-            if result['status'] == 'DONE':
-                logger.debug("done.")
-                if 'error' in result:
-                    raise Exception(result['error'])
-                return result
-            time.sleep(1)
+                disk=self.data_disk.name,
+            ), self.project, write=True)
+            return _wait_for_operation(self.service, self.project, self.zone, operation['name'])
+        except Exception as e:
+            logger.warning('error: {}'.format(e))
+            return {'status': "DONE"}
+
+    @property
+    def config(self):
+        """APIパラメータ."""
+        disk = self.data_disk
+        _config = {
+            "name": disk.name,
+            "type": "projects/{}/zones/{}/diskTypes/{}".format(self.project,
+                                                             self.zone,
+                                                             disk.disk_type),
+        }
+        if disk.source_snapshot:
+            _config["sourceSnapshot"] = disk.source_snapshot
+        else:
+            _config["sourceImage"] = disk.source_image
+        if disk.size_gb:
+            _config["sizeGb"] = disk.size_gb
+        return _config
+
+
+def get_default_service_account(project):
+    """プロジェクトのCompute Engineのデフォルトサービスアカウントを取得する."""
+    return _execute(_service().projects().get(project=project), project)['defaultServiceAccount']
+
+
+def configure_rate_limits(read=None, write=None, project=None):
+    """Compute APIのレート制限(回/秒)を変更する. projectを指定しない場合は全プロジェクトの既定値を変更する."""
+    with _LIMITERS_LOCK:
+        for kind, rate in (('read', read), ('write', write)):
+            if not rate:
+                continue
+            _RATE_LIMITS.setdefault(project, {})[kind] = rate
+            # 次の呼び出しで新しいレートのバケットを作り直す. 既定値の変更は個別に指定したプロジェクトには適用しない
+            for p, k in list(_LIMITERS):
+                if k == kind and (p == project or project is None
+                                  and kind not in _RATE_LIMITS.get(p, {})):
+                    del _LIMITERS[(p, k)]
+
+
+def get_rate_limit_stats(project=None):
+    """Compute APIのレート制限の飽和状況を取得する. projectを指定しない場合はプロジェクトごとの辞書を返す."""
+    with _LIMITERS_LOCK:
+        limiters = dict(_LIMITERS)
+    if project is not None:
+        return {kind: limiter.stats for (p, kind), limiter in limiters.items() if p == project}
+    stats = {}
+    for (p, kind), limiter in limiters.items():
+        stats.setdefault(p, {})[kind] = limiter.stats
+    return stats
+
+
+def _limiter(project, kind):
+    """プロジェクトのレート制限のバケットを取得する"""
+    with _LIMITERS_LOCK:
+        key = (project, kind)
+        if key not in _LIMITERS:
+            rate = _RATE_LIMITS.get(project, {}).get(kind) or _RATE_LIMITS[None][kind]
+            _LIMITERS[key] = ratelimit.TokenBucket(rate)
+        return _LIMITERS[key]
+
+
+def _execute(request, project, write=False):
+    """projectのレート制限に従ってAPIを呼び出し、レート制限のエラーであればバックオフしてリトライする."""
+    limiter = _limiter(project, 'write' if write else 'read')
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            return request.execute()
+        except HttpError as e:
+            if not ratelimit.is_rate_limited(e) or attempt >= _MAX_RETRIES:
+                raise
+            limiter.record_rate_limited()
+            wait = ratelimit.backoff(attempt)
+            logger.debug('rate limit exceeded, retry after {:.1f}s'.format(wait))
+            time.sleep(wait)
+            attempt += 1
+
+
+def _service():
+    """スレッドごとにAPIクライアントを使い回す."""
+    if not hasattr(_LOCAL, 'service'):
+        # googleapiclientがImportErrorをたくさん出すので抑制
+        logging.disable(logging.FATAL)
+        try:
+            _LOCAL.service = build('compute', 'v1')
+        finally:
+            logging.disable(logging.NOTSET)
+    return _LOCAL.service
+
+
+def _wait_for_operation(service, project, zone, operation):
+    """ゾーンオペレーションの待機. ポーリングによって実現."""
+    logger.debug(f'Waiting for {operation} to finish...')
+    while True:
+        result = _execute(service.zoneOperations().get(
+            project=project,
+            zone=zone,
+            operation=operation), project)
+
+        if result['status'] == 'DONE':
+            logger.debug("done.")
+            if 'error' in result:
+                raise Exception(result['error'])
+            return result
+        time.sleep(1)
@@ -1,5 +1,5 @@
 import logging
-import sys
+import queue
 import time
 from contextlib import contextmanager
 
@@ -17,8 +17,11 @@ class PublishClient:
         self.service = pubsub.PublisherClient()
 
     def publish(self, topic, data, **kwargs):
-        """通知イベントの発行."""
-        topic_path = self.service.topic_path(self.project, topic)
+        """通知イベントの発行. 別のプロジェクトのトピックはフルパス(projects/<project>/topics/<topic>)で指定する."""
+        if topic.startswith('projects/'):
+            topic_path = topic
+        else:
+            topic_path = self.service.topic_path(self.project, topic)
         data = data.encode('utf-8')
         self.service.publish(topic_path, data, **kwargs)
 
@@ -30,6 +33,14 @@ class PublishClient:
             pass
         return topic_path
 
+    def add_publishers(self, topic, members):
+        """トピックへの発行を許可する."""
+        topic_path = self.service.topic_path(self.project, topic)
+        policy = self.service.get_iam_policy(topic_path)
+        policy.bindings.add(role='roles/pubsub.publisher', members=members)
+        self.service.set_iam_policy(topic_path, policy)
+        logger.info('add publishers: {} ( {} )'.format(members, topic_path))
+
     def delete_topic(self, topic):
         topic_path = self.service.topic_path(self.project, topic)
         try:
@@ -46,26 +57,51 @@ class SubscribeClient:
         self.project = project
         self.service = pubsub.SubscriberClient()
 
-    def subscribe_async(self, subscription, callback):
-        """通知の購読(非同期)."""
-        path = self.service.subscription_path(self.project, subscription)
-        return self.service.subscribe(path, callback)
-
-    def subscribe(self, subscription, callback, stop_callback, sleep=1):
-        """通知の購読."""
+    def subscribe_async(self, subscription, callback, flow_control=None):
+        """通知の購読(非同期).
 
-        def _callback(message):
-            r = callback(message)
-            message.ack()
-            return r
-
-        future = self.subscribe_async(subscription, _callback)
+        :param flow_control: pubsub.types.FlowControlの引数(max_messages, max_bytesなど)
+        """
+        path = self.service.subscription_path(self.project, subscription)
+        flow_control = pubsub.types.FlowControl(**(flow_control or {}))
+        return self.service.subscribe(path, callback, flow_control=flow_control)
+
+    def subscribe(self,
+                  subscription,
+                  callback,
+                  stop_callback,
+                  sleep=1,
+                  flow_control=None,
+                  max_batch_size=100,
+                  progress=None):
+        """通知の購読.
+
+        受信したメッセージは最大max_batch_size件ずつまとめてcallbackに渡し、処理後にまとめてackする。
+        :param callback: メッセージのリストを引数にとる関数
+        :param stop_callback: Trueを返すと購読を終了する関数
+        :param sleep: メッセージがない場合にstop_callbackを呼び出す間隔(秒)
+        :param flow_control: pubsub.types.FlowControlの引数
+        :param max_batch_size: 一度にcallbackに渡すメッセージの最大数
+        :param progress: 定期的に呼び出す進捗表示用の関数
+        """
+        messages = queue.Queue()
+        future = self.subscribe_async(subscription, messages.put, flow_control)
         try:
-            for spinner in _spinner():
-                sys.stdout.write(spinner)
-                sys.stdout.flush()
-                time.sleep(sleep)
-                sys.stdout.write('\b')
+            while True:
+                batch = _get_batch(messages, max_batch_size, sleep)
+                if batch:
+                    try:
+                        callback(batch)
+                    except Exception as e:
+                        # 再配信させる
+                        logger.warning('error: {}'.format(e))
+                        for message in batch:
+                            message.nack()
+                    else:
+                        for message in batch:
+                            message.ack()
+                if progress:
+                    progress()
                 if stop_callback():
                     logger.info('stop subscribing')
                     break
@@ -106,9 +142,15 @@ def context(project, topic, subscription):
         publisher.delete_topic(topic)
 
 
-def _spinner():
-    while True:
-        yield '|'
-        yield '/'
-        yield '-'
-        yield '\\'
+def _get_batch(messages, max_size, timeout):
+    """最初の1件はtimeout秒まで待ち、以降はすでに届いているものを最大max_size件まで取り出す"""
+    try:
+        batch = [messages.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(batch) < max_size:
+        try:
+            batch.append(messages.get_nowait())
+        except queue.Empty:
+            break
+    return batch
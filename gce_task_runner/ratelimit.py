@@ -0,0 +1,76 @@
+import random
+import threading
+import time
+
+# レート制限を表すHTTP 403のreason
+_RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+class TokenBucket:
+    """スレッドセーフなトークンバケット.
+
+    トークンが足りない場合は前借りして、その分だけ待機する。
+    """
+
+    def __init__(self, rate, capacity=None):  # noqa: D107
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        # 飽和状況の計測値
+        self.acquired = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self.rate_limited = 0
+
+    def acquire(self):
+        """トークンを1つ取得する. 待機した秒数を返す."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            self.acquired += 1
+            if wait:
+                self.throttled += 1
+                self.wait_seconds += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def record_rate_limited(self):
+        """APIからレート制限のエラーが返ってきたことを記録する."""
+        with self._lock:
+            self.rate_limited += 1
+
+    @property
+    def stats(self):
+        """計測値."""
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'acquired': self.acquired,
+                'throttled': self.throttled,
+                'wait_seconds': self.wait_seconds,
+                'rate_limited': self.rate_limited,
+            }
+
+
+def is_rate_limited(error):
+    """HttpErrorがレート制限によるものかどうか"""
+    status = int(getattr(getattr(error, 'resp', None), 'status', 0) or 0)
+    if status == 429:
+        return True
+    if status == 403:
+        content = getattr(error, 'content', b'') or b''
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        return any(reason in content or reason in str(error) for reason in _RATE_LIMIT_REASONS)
+    return False
+
+
+def backoff(attempt, base=1, cap=64):
+    """リトライまでの待機秒数. 指数的に増える上限の範囲でランダムにする."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
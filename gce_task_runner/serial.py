@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import store
+
+logger = logging.getLogger(__name__)
+
+
+class _State:
+    """インスタンスごとの取得状況."""
+
+    def __init__(self, interval):  # noqa: D107
+        self.offset = 0
+        self.interval = interval
+        self.next_time = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        # capture()した時点の_schedule()の世代
+        self.closed_generation = None
+        # 取得待ちまたは取得中. 重複して投入しない
+        self.polling = False
+
+
+class SerialLogCollector:
+    """storeに登録された稼働中インスタンスのシリアルポート出力を差分取得するクラス.
+
+    出力があったインスタンスは min_interval 秒間隔、出力がない間は max_interval 秒まで
+    間隔を倍々にしてポーリングする。
+    log_dir を指定した場合はインスタンスごとのファイルに、それ以外はloggingに出力する。
+    削除前の最後の取得は capture_timeout 秒で打ち切り、削除を遅らせない。
+    """
+
+    def __init__(self,
+                 log_dir=None,
+                 concurrency=10,
+                 min_interval=5,
+                 max_interval=60,
+                 capture_timeout=5):  # noqa: D107
+        self.log_dir = log_dir
+        self.concurrency = concurrency
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.capture_timeout = capture_timeout
+        self._states = {}
+        # _schedule()の実行回数. capture()済みの状態を捨ててよいかの判定に使う
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+
+    def start(self):
+        """バックグラウンドでの収集を開始する."""
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """収集を終了する."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+    def capture(self, instance_id, instance):
+        """インスタンス削除前に残りの出力を取得して以降の収集を打ち切る."""
+        state = self._get_state(instance_id)
+        # 取得中のポーリングがあれば終わるのを待つ
+        if not state.lock.acquire(timeout=self.capture_timeout):
+            return
+        try:
+            if state.closed:
+                return
+            # 削除前のstoreの一覧から再び収集しないように、状態は閉じたまま残しておく
+            with self._lock:
+                state.closed = True
+                state.closed_generation = self._generation
+        finally:
+            state.lock.release()
+        thread = threading.Thread(target=self._fetch, args=(instance, state), daemon=True)
+        thread.start()
+        thread.join(self.capture_timeout)
+        if thread.is_alive():
+            logger.debug('serial port output of {} is not captured in {}s'.format(
+                instance.instance, self.capture_timeout))
+
+    def _get_state(self, instance_id):
+        with self._lock:
+            if instance_id not in self._states:
+                self._states[instance_id] = _State(self.min_interval)
+            return self._states[instance_id]
+
+    def _loop(self):
+        while not self._stop.wait(1):
+            self._schedule(time.time())
+
+    def _schedule(self, now):
+        """取得時刻になったインスタンスのポーリングを投入する"""
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        instances = store.get_instances()
+        for _id, instance in instances:
+            state = self._get_state(_id)
+            if state.next_time > now or state.closed or state.polling:
+                continue
+            state.polling = True
+            self._executor.submit(self._poll, instance, state)
+        # storeから取り出された後の一覧を使った回より前にcapture()した状態と、
+        # 出力を取得しないまま削除されたインスタンスの状態は捨てる
+        ids = {_id for _id, _ in instances}
+        with self._lock:
+            for _id in [_id for _id, state in self._states.items() if _id not in ids and (
+                    state.closed_generation is not None and state.closed_generation < generation
+                    or not state.closed and not state.offset and not state.polling)]:
+                del self._states[_id]
+
+    def _poll(self, instance, state):
+        if not state.lock.acquire(blocking=False):
+            # capture中
+            state.polling = False
+            return
+        try:
+            if state.closed:
+                return
+            if self._fetch(instance, state):
+                state.interval = self.min_interval
+            else:
+                state.interval = min(state.interval * 2, self.max_interval)
+            state.next_time = time.time() + state.interval
+        finally:
+            state.polling = False
+            state.lock.release()
+
+    def _fetch(self, instance, state):
+        """前回の続きから出力を取得する. 新しい出力があればTrueを返す."""
+        try:
+            result = instance.get_serial_port_output(start=state.offset)
+        except Exception as e:
+            # 起動直後や削除済みの場合は取得できない
+            logger.debug('serial port output of {} is not available: {}'.format(
+                instance.instance, e))
+            return False
+        state.offset = int(result.get('next', state.offset))
+        contents = result.get('contents', '')
+        if contents:
+            self._write(instance.instance, contents)
+        return bool(contents)
+
+    def _write(self, name, contents):
+        if self.log_dir:
+            with open(os.path.join(self.log_dir, '{}.log'.format(name)), 'a') as f:
+                f.write(contents)
+        else:
+            for line in contents.splitlines():
+                logger.info('[{}] {}'.format(name, line))
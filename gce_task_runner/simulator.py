@@ -0,0 +1,313 @@
+import heapq
+import itertools
+import random
+import re
+from collections import deque
+
+from . import catalog, trace
+
+
+class Profile:
+    """インスタンスの所要時間(秒)の経験分布."""
+
+    def __init__(self,
+                 create_latency,
+                 runtime,
+                 delete_latency,
+                 preemption_rate=0.0):  # noqa: D107
+        if not (create_latency and runtime and delete_latency):
+            raise ValueError('Profile needs at least one sample of each latency')
+        self.create_latency = list(create_latency)
+        self.runtime = list(runtime)
+        self.delete_latency = list(delete_latency)
+        self.preemption_rate = preemption_rate
+
+
+class Traces:
+    """run(trace_path=...)で記録したトレースから、パラメータごとのProfileを作るクラス."""
+
+    def __init__(self, events):  # noqa: D107
+        instances = {}
+        for event in events:
+            if 'instance_id' not in event:
+                continue
+            record = instances.setdefault(event['instance_id'], {})
+            record[event['event']] = event
+        self.records = [record for record in instances.values() if 'created' in record]
+
+    def profile(self, parameter):
+        """マシンタイプとプリエンプティブが一致するトレースからProfileを作る. なければ条件を緩める."""
+        records = [r for r in self.records
+                   if r['created'].get('machine_type') == parameter.machine_type
+                   and r['created'].get('preemptible') == parameter.preemptible]
+        if not records:
+            records = [r for r in self.records
+                       if r['created'].get('preemptible') == parameter.preemptible]
+        if not records:
+            records = self.records
+        return Profile(
+            create_latency=[r['created']['latency'] for r in records],
+            runtime=[r['completed']['time'] - r['created']['time']
+                     for r in records if 'completed' in r],
+            delete_latency=[r['deleted']['latency'] for r in records if 'deleted' in r],
+            preemption_rate=len([r for r in records if 'preempted' in r]) / len(records),
+        )
+
+
+def load_traces(*paths):
+    """トレースファイルを読み込む."""
+    return Traces([event for path in paths for event in trace.load(path)])
+
+
+class SimulationResult:
+    """シミュレーション結果."""
+
+    def __init__(self):  # noqa: D107
+        # run()が戻るまで(全インスタンスの削除完了まで)の秒数
+        self.makespan = 0.0
+        # タスクごとの開始から最後の完了通知までの秒数
+        self.task_durations = {}
+        self.peak_instances = 0
+        self.peak_vcpus = 0
+        self.peak_gpus = 0
+        self.vm_hours = 0.0
+        self.cost = 0.0
+        # プリエンプションされたインスタンス数
+        self.preempted = 0
+        # timeoutがないタスクでプリエンプションされ、実際には終了しないインスタンス数
+        self.hung = 0
+
+    def __repr__(self):  # noqa: D105
+        return 'SimulationResult({})'.format(
+            ', '.join('{}={!r}'.format(k, v) for k, v in self.__dict__.items()))
+
+
+def simulate(tasks, traces, quota=None, price_per_hour=None, zone_catalog=None, seed=0):
+    """トレースの分布を使い、run()と同じスケジューリングでタスクリストの実行をシミュレーションする.
+
+    クラウドにはアクセスしない。
+    :param tasks: Taskのリスト
+    :param traces: Traces、または parameter を引数にとり Profile を返す profile() を持つオブジェクト
+    :param quota: {'instances': 台数, 'vcpus': vCPU数, 'gpus': GPU数} の上限
+    :param price_per_hour: {マシンタイプ: 1時間あたりの料金}、またはParameterを引数にとる関数
+    :param zone_catalog: vCPU数の取得に使うcatalog.Catalog. なければマシンタイプ名から推定する
+    :param seed: 乱数のシード
+    :return: SimulationResult
+    """
+    return _Simulation(traces, quota or {}, price_per_hour, zone_catalog, seed).run(list(tasks))
+
+
+class _Instance:
+    __slots__ = ('state', 'number', 'created_at', 'deleted')
+
+    def __init__(self, state, number):
+        self.state = state
+        self.number = number
+        self.created_at = None
+        self.deleted = False
+
+
+class _TaskState:
+    """1つのタスクの実行状況. storeと_run_taskに相当する."""
+
+    def __init__(self, task, profile, need, price, started_at):
+        self.task = task
+        self.profile = profile
+        self.need = need
+        self.price = price
+        self.started_at = started_at
+        self.next_number = 0
+        self.backups = deque()
+        self.workers = task.create_concurrency
+        # async_runはconcurrency*10台ごとに全ての作成を待ってから次に進む
+        self.chunk_size = task.create_concurrency * 10
+        self.creating = 0
+        self.remains = task.parameter.instances
+        self.resolved = set()
+        self.lives = {}
+        self.speculated = False
+
+    @property
+    def fanned_out(self):
+        """元のインスタンスを全て作成し終えたか."""
+        return self.next_number >= self.task.parameter.instances and self.creating == 0
+
+
+class _Simulation:
+
+    def __init__(self, traces, quota, price_per_hour, zone_catalog, seed):
+        self.traces = traces
+        self.quota = quota
+        self.price_per_hour = price_per_hour
+        self.zone_catalog = zone_catalog
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.events = []
+        self.seq = itertools.count()
+        self.usage = {'instances': 0, 'vcpus': 0, 'gpus': 0}
+        self.blocked = deque()
+        self.result = SimulationResult()
+        self.tasks = deque()
+        self.current = None
+
+    def run(self, tasks):
+        self.tasks.extend(tasks)
+        self._start_next_task()
+        while self.events:
+            self.now, _, handler, args = heapq.heappop(self.events)
+            handler(*args)
+        if self.blocked:
+            raise RuntimeError('quota is too small to create an instance')
+        self.result.makespan = self.now
+        return self.result
+
+    def _schedule(self, delay, handler, *args):
+        heapq.heappush(self.events, (self.now + delay, next(self.seq), handler, args))
+
+    def _sample(self, samples):
+        return self.rng.choice(samples)
+
+    def _start_next_task(self):
+        if not self.tasks:
+            self.current = None
+            return
+        task = self.tasks.popleft()
+        self.current = _TaskState(task, self.traces.profile(task.parameter),
+                                  self._resources(task), self._price(task.parameter), self.now)
+        self._dispatch(self.current)
+        self._check_task_end(self.current)
+
+    def _resources(self, task):
+        parameter = task.parameter
+        if self.zone_catalog:
+            cpus, gpus = self.zone_catalog.resources(task.project, parameter)
+        else:
+            gpus = parameter.gpu_info[0] if parameter.gpu_info else 0
+            custom = catalog._parse_custom(parameter.machine_type)
+            match = re.search(r'-(\d+)$', parameter.machine_type)
+            cpus = custom[0] if custom else int(match.group(1)) if match else None
+        return {'instances': 1, 'vcpus': cpus or 1, 'gpus': gpus}
+
+    def _price(self, parameter):
+        if callable(self.price_per_hour):
+            return self.price_per_hour(parameter)
+        return (self.price_per_hour or {}).get(parameter.machine_type, 0.0)
+
+    def _dispatch(self, state):
+        """空いている作成スレッドでインスタンスの作成を始める"""
+        while state.workers > 0:
+            if state.next_number < state.task.parameter.instances:
+                if state.next_number % state.chunk_size == 0 \
+                        and state.workers < state.task.create_concurrency:
+                    # 前のチャンクの作成が終わるまで待つ
+                    return
+                number = state.next_number
+                state.next_number += 1
+            elif state.backups:
+                number = state.backups.popleft()
+                if number in state.resolved:
+                    continue
+            else:
+                return
+            state.workers -= 1
+            self._create(state, number)
+
+    def _fits(self, need):
+        return all(self.usage[k] + need[k] <= self.quota[k] for k in need if k in self.quota)
+
+    def _create(self, state, number):
+        if not self._fits(state.need):
+            # QUOTAが空くまで削除を待つ
+            self.blocked.append((state, number))
+            return
+        for k, v in state.need.items():
+            self.usage[k] += v
+        self.result.peak_instances = max(self.result.peak_instances, self.usage['instances'])
+        self.result.peak_vcpus = max(self.result.peak_vcpus, self.usage['vcpus'])
+        self.result.peak_gpus = max(self.result.peak_gpus, self.usage['gpus'])
+        state.creating += 1
+        instance = _Instance(state, number)
+        self._schedule(self._sample(state.profile.create_latency), self._on_created, instance)
+
+    def _on_created(self, instance):
+        state = instance.state
+        state.creating -= 1
+        state.workers += 1
+        instance.created_at = self.now
+        if instance.number in state.resolved:
+            # 作成中に不要になった複製
+            self._delete(instance)
+        else:
+            state.lives.setdefault(instance.number, []).append(instance)
+            timeout = state.task.timeout
+            runtime = self._sample(state.profile.runtime)
+            if self.rng.random() < state.profile.preemption_rate:
+                self.result.preempted += 1
+                if timeout:
+                    self._schedule(timeout, self._on_finished, instance, False)
+                else:
+                    self.result.hung += 1
+                    self._schedule(runtime, self._on_finished, instance, False)
+            elif timeout and runtime > timeout:
+                self._schedule(timeout, self._on_finished, instance, False)
+            else:
+                self._schedule(runtime, self._on_finished, instance, True)
+        self._dispatch(state)
+        self._speculate(state)
+        self._check_task_end(state)
+
+    def _on_finished(self, instance, completed):
+        state = instance.state
+        if instance.deleted:
+            return
+        lives = state.lives.get(instance.number, [])
+        lives.remove(instance)
+        if completed:
+            # 投機実行の複製は先に完了した方を採用して残りは削除する
+            for sibling in lives:
+                self._delete(sibling)
+            lives.clear()
+        if not lives:
+            state.lives.pop(instance.number, None)
+        if instance.number not in state.resolved and (completed or not lives):
+            state.resolved.add(instance.number)
+            state.remains -= 1
+        self._delete(instance)
+        self._speculate(state)
+        self._check_task_end(state)
+
+    def _speculate(self, state):
+        ratio = state.task.speculative_ratio
+        instances = state.task.parameter.instances
+        if not ratio or state.speculated or not state.fanned_out \
+                or instances - state.remains < instances * ratio:
+            return
+        state.speculated = True
+        state.backups.extend(number for number, lives in state.lives.items() if len(lives) == 1)
+        self._dispatch(state)
+
+    def _delete(self, instance):
+        instance.deleted = True
+        self._schedule(self._sample(instance.state.profile.delete_latency),
+                       self._on_deleted, instance)
+
+    def _on_deleted(self, instance):
+        state = instance.state
+        for k, v in state.need.items():
+            self.usage[k] -= v
+        hours = (self.now - instance.created_at) / 3600
+        self.result.vm_hours += hours
+        self.result.cost += hours * state.price
+        # QUOTA待ちの作成を再開する
+        blocked, self.blocked = self.blocked, deque()
+        for blocked_state, number in blocked:
+            self._create(blocked_state, number)
+
+    def _check_task_end(self, state):
+        # 全台の完了通知を受信し、複製の作成も終わっていれば次のタスクを始める. 削除の完了は待たない
+        if state is not self.current or state.remains > 0 or state.creating > 0:
+            return
+        if any(s is state for s, _ in self.blocked):
+            return
+        self.result.task_durations[state.task.name] = self.now - state.started_at
+        self._start_next_task()
@@ -4,13 +4,25 @@ from functools import wraps
 
 _INSTANCES = {}
 _INSTANCE_SIZE = None
+# インスタンスIDとタスク内の通し番号の対応. 投機実行では1つの通し番号に複数のインスタンスが対応する
+_NUMBERS = {}
+_LIVES = {}
+_RESOLVED = set()
+_SPECULATIONS = {}
+# pop_all()以降は新たに格納しない
+_CLOSED = False
 
 _LOCK = threading.Lock()
 
 
 def initialize(total_instance_size):
-    global _INSTANCE_SIZE
+    global _INSTANCE_SIZE, _CLOSED
     _INSTANCE_SIZE = int(total_instance_size)
+    _CLOSED = False
+    _NUMBERS.clear()
+    _LIVES.clear()
+    _RESOLVED.clear()
+    _SPECULATIONS.clear()
 
 
 def _check_initialized(f):
@@ -26,32 +38,132 @@ def _check_initialized(f):
 
 
 @_check_initialized
-def register(instance_id, instance, timeout=0):
-    """_INSTANCESにGCEインスタンスを格納する"""
+def register(instance_id, instance, timeout=0, number=None):
+    """_INSTANCESにGCEインスタンスを格納する
+
+    同じnumberで複数登録した場合は投機実行として記録し、いずれか1台の完了でその番号を完了とする。
+    すでに完了した番号の場合やpop_all()の後は格納せずにFalseを返す。
+    """
     with _LOCK:
+        key = instance_id if number is None else number
+        if _CLOSED or key in _RESOLVED:
+            return False
         limit = timeout + time.time() if timeout else None
         _INSTANCES[instance_id] = (instance, limit)
+        _NUMBERS[instance_id] = key
+        lives = _LIVES.setdefault(key, [])
+        lives.append(instance_id)
+        if len(lives) > 1:
+            speculation = _SPECULATIONS.setdefault(
+                key, {'instances': lives[:-1], 'winner': None})
+            speculation['instances'].append(instance_id)
+        return True
+
+
+def _remove(instance_id, completed):
+    """_INSTANCESからインスタンスを取り除き、必要であれば残数を減らす. _LOCK内で呼ぶこと"""
+    global _INSTANCE_SIZE
+    instance = _INSTANCES.pop(instance_id, None)
+    if instance is None:
+        return None
+    key = _NUMBERS.pop(instance_id)
+    lives = _LIVES.get(key, [])
+    lives.remove(instance_id)
+    if not lives:
+        _LIVES.pop(key, None)
+    # 完了したか、その番号のインスタンスが全ていなくなった時点で1台分とする
+    if key not in _RESOLVED and (completed or not lives):
+        _RESOLVED.add(key)
+        _INSTANCE_SIZE -= 1
+        if completed and key in _SPECULATIONS:
+            _SPECULATIONS[key]['winner'] = instance_id
+    return instance
 
 
 @_check_initialized
 def pop(instance_id):
     """_INSTANCESに格納されたGCEインスタンスを取り出す"""
-    global _INSTANCE_SIZE
     with _LOCK:
-        instance = _INSTANCES.pop(instance_id, (None, None))
-        if instance[0]:
-            _INSTANCE_SIZE -= 1
-        return instance
+        return _remove(instance_id, completed=True) or (None, None)
+
+
+def _remove_siblings(instance_id):
+    """同じ番号の他のインスタンスを取り除く. _LOCK内で呼ぶこと"""
+    key = _NUMBERS.get(instance_id)
+    if key is None:
+        return []
+    ids = [_id for _id in _LIVES.get(key, []) if _id != instance_id]
+    return [(_id, _remove(_id, completed=False)) for _id in ids]
+
+
+@_check_initialized
+def pop_siblings(instance_id):
+    """指定したインスタンスと同じ番号の他のGCEインスタンスを全て取り出す"""
+    with _LOCK:
+        return _remove_siblings(instance_id)
+
+
+@_check_initialized
+def pop_completions(instance_ids):
+    """完了通知のあったGCEインスタンスを、同じ番号の他のGCEインスタンスと共にまとめて取り出す
+
+    :return: (インスタンスID, (インスタンス, 期限), [(他のインスタンスID, (インスタンス, 期限))])のリスト
+    """
+    with _LOCK:
+        results = []
+        for instance_id in instance_ids:
+            siblings = _remove_siblings(instance_id)
+            instance = _remove(instance_id, completed=True) or (None, None)
+            results.append((instance_id, instance, siblings))
+        return results
+
+
+@_check_initialized
+def pop_all():
+    """_INSTANCESに格納されたGCEインスタンスを全て取り出し、以降は格納しないようにする"""
+    global _INSTANCE_SIZE, _CLOSED
+    with _LOCK:
+        _CLOSED = True
+        instances = [(_id, _remove(_id, completed=False)) for _id in list(_INSTANCES)]
+        _INSTANCE_SIZE = 0
+        return instances
 
 
 @_check_initialized
 def get_time_overs():
     """_INSTANCESに格納された期限切れGCEインスタンスを全て取り出す"""
-    global _INSTANCE_SIZE
     with _LOCK:
         ids = [_id for _id, (_, limit) in _INSTANCES.items() if limit and limit < time.time()]
-        _INSTANCE_SIZE -= len(ids)
-        return [(_id, _INSTANCES.pop(_id)) for _id in ids]
+        return [(_id, _remove(_id, completed=False)) for _id in ids]
+
+
+@_check_initialized
+def is_resolved(number):
+    """その番号のインスタンスが完了済みかどうか"""
+    with _LOCK:
+        return number in _RESOLVED
+
+
+@_check_initialized
+def get_unspeculated():
+    """投機実行していない実行中の番号とGCEインスタンスの一覧を取得する"""
+    with _LOCK:
+        return [(key, _INSTANCES[ids[0]][0]) for key, ids in _LIVES.items()
+                if key not in _SPECULATIONS and key not in _RESOLVED]
+
+
+@_check_initialized
+def get_speculations():
+    """投機実行の記録を取得する"""
+    with _LOCK:
+        return [dict(number=key, **speculation) for key, speculation in _SPECULATIONS.items()]
+
+
+@_check_initialized
+def get_instances():
+    """_INSTANCESに格納されたGCEインスタンスの一覧を取得する(取り出さない)"""
+    with _LOCK:
+        return [(_id, instance) for _id, (instance, _) in _INSTANCES.items()]
 
 
 @_check_initialized
@@ -0,0 +1,35 @@
+import json
+import threading
+import time
+
+
+class Recorder:
+    """インスタンスのライフサイクルのイベントをJSON Linesで記録するクラス.
+
+    記録したファイルはsimulator.load_traces()で読み込める。
+    """
+
+    def __init__(self, path):  # noqa: D107
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def record(self, event, **fields):
+        """イベントを記録する."""
+        line = json.dumps(dict(event=event, time=time.time(), **fields))
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        """ファイルを閉じる."""
+        with self._lock:
+            self._file.close()
+
+
+def load(path):
+    """記録したイベントを読み込む."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
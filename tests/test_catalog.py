@@ -0,0 +1,93 @@
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from gce_task_runner import catalog, core, GPU, Parameter, Task
+
+ZONES = {
+    'asia-northeast1-b': {
+        'machine_types': {
+            'n1-standard-1': {'cpus': 1, 'memory_mb': 3840},
+            'n2-standard-4': {'cpus': 4, 'memory_mb': 16384},
+        },
+        'accelerators': {'nvidia-tesla-k80': 8},
+        'cpu_platforms': ['Intel Broadwell', 'Intel Skylake'],
+    },
+}
+
+
+def _parameter(**kwargs):
+    return Parameter(instance_name='instance-{}', startup_script='#!/bin/bash', **kwargs)
+
+
+class CatalogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.catalog = catalog.Catalog(catalog.StaticSource(ZONES), cache_dir=self.cache_dir.name)
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_validate(self):
+        self.assertEqual([], self.catalog.validate('project', _parameter()))
+        self.assertEqual([], self.catalog.validate('project', _parameter(
+            machine_type='custom-2-4096', gpu_info=(2, GPU.K80), minCpuPlatform='Intel Skylake')))
+
+    def test_validate_errors(self):
+        self.assertEqual(['zone us-central1-a is not available'],
+                         self.catalog.validate('project', _parameter(zone='us-central1-a')))
+        self.assertEqual(
+            ['machine type n1-highmem-96 is not available in asia-northeast1-b'],
+            self.catalog.validate('project', _parameter(machine_type='n1-highmem-96')))
+        self.assertEqual(
+            ['nvidia-tesla-v100 is not available in asia-northeast1-b'],
+            self.catalog.validate('project', _parameter(gpu_info=(1, GPU.V100))))
+        self.assertEqual(
+            ['nvidia-tesla-k80 supports up to 8 per instance'],
+            self.catalog.validate('project', _parameter(gpu_info=(16, GPU.K80))))
+        self.assertEqual(
+            ['GPUs cannot be attached to n2-standard-4'],
+            self.catalog.validate('project', _parameter(machine_type='n2-standard-4',
+                                                        gpu_info=(1, GPU.K80))))
+        self.assertEqual(
+            ['Intel Ice Lake is not available in asia-northeast1-b'],
+            self.catalog.validate('project', _parameter(minCpuPlatform='Intel Ice Lake')))
+
+    def test_resources(self):
+        self.assertEqual((4, 0), self.catalog.resources(
+            'project', _parameter(machine_type='n2-standard-4')))
+        self.assertEqual((6, 2), self.catalog.resources(
+            'project', _parameter(machine_type='custom-6-8192', gpu_info=(2, GPU.K80))))
+        self.assertEqual((None, 0), self.catalog.resources(
+            'project', _parameter(machine_type='unknown')))
+
+    def test_cache(self):
+        source = Mock()
+        source.fetch.return_value = ZONES
+        catalog.Catalog(source, cache_dir=self.cache_dir.name).zones('project')
+        # ttl以内であればディスクのキャッシュを使う
+        self.assertEqual(
+            ZONES, catalog.Catalog(source, cache_dir=self.cache_dir.name).zones('project'))
+        source.fetch.assert_called_once_with('project')
+        catalog.Catalog(source, cache_dir=self.cache_dir.name, ttl=-1).zones('project')
+        self.assertEqual(2, source.fetch.call_count)
+
+
+class ValidateTestCase(unittest.TestCase):
+
+    def test_validate(self):
+        tasks = [Task('task1', 'project', _parameter()),
+                 Task('task2', 'project', _parameter(machine_type='n1-highmem-96'))]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            zone_catalog = catalog.Catalog(catalog.StaticSource(ZONES), cache_dir=cache_dir)
+            # インスタンスを作成する前に全タスクを検証する
+            with self.assertRaises(ValueError) as cm:
+                core._validate(tasks, zone_catalog)
+        self.assertIn('task2: project: machine type n1-highmem-96', str(cm.exception))
+
+    def test_validate_unavailable(self):
+        zone_catalog = Mock()
+        zone_catalog.validate.side_effect = Exception('no credentials')
+        # カタログを取得できない場合は検証しない
+        core._validate([Task('task1', 'project', _parameter())], zone_catalog)
@@ -1,7 +1,13 @@
+import os
+import tempfile
+import threading
+import time
 import unittest
+from functools import partial
+from importlib import reload
 from unittest.mock import patch, Mock
 
-from gce_task_runner import notify_completion, run, Task, Parameter
+from gce_task_runner import core, notify_completion, run, store, trace, Task, Parameter, DataDisk
 
 
 class NotifyCompletionTestCase(unittest.TestCase):
@@ -14,11 +20,31 @@ class NotifyCompletionTestCase(unittest.TestCase):
         expected_topic = 'topic'
         expected_instance = 'xxx_id'
         _mock_get_project.side_effect = (expected_project,)
-        _mock_get_metadata.side_effect = (expected_topic, expected_instance)
+        expected_run_id = 'run_id'
+        expected_task_id = 'task_id'
+        _mock_get_metadata.side_effect = (
+            expected_topic, expected_instance, expected_run_id, expected_task_id)
         publisher = Mock(return_value='')
         _mock_publisher.return_value = publisher
         notify_completion()
         _mock_publisher.assert_called_once_with(expected_project)
+        publisher.publish.assert_called_once_with(
+            expected_topic, expected_instance, run_id=expected_run_id, task_id=expected_task_id)
+
+    @patch('gce_task_runner.pubsub.PublishClient')
+    @patch('gce_task_runner.core._get_metadata')
+    @patch('gce_task_runner.core._get_project')
+    def test_notify_completion_no_task_id(self, _mock_get_project, _mock_get_metadata,
+                                          _mock_publisher):
+        expected_project = 'project'
+        expected_topic = 'topic'
+        expected_instance = 'xxx_id'
+        _mock_get_project.side_effect = (expected_project,)
+        _mock_get_metadata.side_effect = (expected_topic, expected_instance, None, None)
+        publisher = Mock(return_value='')
+        _mock_publisher.return_value = publisher
+        notify_completion()
+        # 古いマネージャーから作成された場合は属性を付けない
         publisher.publish.assert_called_once_with(expected_topic, expected_instance)
 
     @patch('gce_task_runner.pubsub.PublishClient')
@@ -30,13 +56,14 @@ class NotifyCompletionTestCase(unittest.TestCase):
         expected_instance = 'xxx_id'
         expected_error = 'Error'
         _mock_get_project.side_effect = (expected_project,)
-        _mock_get_metadata.side_effect = (expected_topic, expected_instance)
+        _mock_get_metadata.side_effect = (expected_topic, expected_instance, 'run_id', 'task_id')
         publisher = Mock(return_value='')
         _mock_publisher.return_value = publisher
         notify_completion(error=expected_error)
         _mock_publisher.assert_called_once_with(expected_project)
         publisher.publish.assert_called_once_with(
-            expected_topic, expected_instance, error=expected_error)
+            expected_topic, expected_instance, error=expected_error,
+            run_id='run_id', task_id='task_id')
 
     @patch('gce_task_runner.pubsub.PublishClient')
     @patch('gce_task_runner.core._get_metadata')
@@ -69,9 +96,10 @@ class NotifyCompletionTestCase(unittest.TestCase):
         publisher.publish.assert_not_called()
 
 
+@patch('gce_task_runner.core._validate')
 class RunTestCase(unittest.TestCase):
     @patch('gce_task_runner.core._run_task')
-    def test_run(self, _mock_run_task):
+    def test_run(self, _mock_run_task, _mock_validate):
         _mock_run_task.return_value = []
         tasks = [
             Task('name', 'project', Parameter(
@@ -86,7 +114,7 @@ class RunTestCase(unittest.TestCase):
         self.assertEqual(None, actual)
 
     @patch('gce_task_runner.core._run_task')
-    def test_run_error(self, _mock_run_task):
+    def test_run_error(self, _mock_run_task, _mock_validate):
         _mock_run_task.side_effect = ([], ['Error'], [])
         tasks = [
             Task('task1', 'project', Parameter(
@@ -114,3 +142,325 @@ class RunTestCase(unittest.TestCase):
         # エラーが発生した時点で終了
         actual = run(tasks)
         self.assertEqual(('task2', ['Error']), actual)
+
+    @patch('gce_task_runner.core._run_task')
+    def test_run_wait_for_deletions(self, _mock_run_task, _mock_validate):
+        # 最後のタスクのインスタンス削除が終わるまで待機する
+        deleted = []
+
+        def _run_task(task, channels):
+            core._submit_deletion(lambda: (time.sleep(0.1), deleted.append(task.name)))
+            return []
+
+        _mock_run_task.side_effect = _run_task
+        tasks = [
+            Task('name', 'project', Parameter(
+                instance_name='instance_name',
+                startup_script='''
+                #!/bin/bash
+                shutdown -h now
+                '''
+            ))
+        ]
+        self.assertEqual(None, run(tasks))
+        self.assertEqual(['name'], deleted)
+        self.assertFalse(core._has_pending_deletions())
+
+    @patch('gce_task_runner.core._run_task')
+    def test_run_trace_cancelled(self, _mock_run_task, _mock_validate):
+        # 中断した場合も削除の記録を終えてからトレースを閉じる
+        def _run_task(task, channels):
+            core._IS_TASK_CANCELLED.set()
+            core._submit_deletion(lambda: (time.sleep(0.1), core._trace('deleted')))
+            return ['Error']
+
+        _mock_run_task.side_effect = _run_task
+        tasks = [Task('name', 'project', Parameter(instance_name='instance_name',
+                                                   startup_script='#!/bin/bash'))]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.jsonl')
+            try:
+                self.assertEqual(('name', ['Error']), run(tasks, trace_path=path))
+            finally:
+                core._IS_TASK_CANCELLED.clear()
+            core._wait_for_deletions()
+            for _ in range(50):
+                if core._RECORDER is None:
+                    break
+                time.sleep(0.1)
+            self.assertIsNone(core._RECORDER)
+            events = [event['event'] for event in trace.load(path)]
+        self.assertEqual(['run_start', 'run_end', 'deleted'], events)
+
+
+class AsyncRunTestCase(unittest.TestCase):
+
+    def test_async_run_concurrency(self):
+        # デフォルトのスレッドプールの上限(32)を超えて並列に実行する
+        barrier = threading.Barrier(50, timeout=5)
+        results = core._async_run(range(50), lambda n: (barrier.wait(), n)[1], 50)
+        self.assertEqual(list(range(50)), results)
+
+
+class RouteTestCase(unittest.TestCase):
+
+    def test_is_stale(self):
+        route = core._Route('project', 'topic', Mock(), 'run_id')
+        self.assertFalse(route.is_stale(
+            Mock(attributes={'run_id': 'run_id', 'task_id': route.task_id})))
+        # 属性がない通知はインスタンスIDで判断する
+        self.assertFalse(route.is_stale(Mock(attributes={})))
+        self.assertTrue(route.is_stale(
+            Mock(attributes={'run_id': 'run_id', 'task_id': 'previous'})))
+        self.assertTrue(route.is_stale(
+            Mock(attributes={'run_id': 'other', 'task_id': route.task_id})))
+
+    @patch('gce_task_runner.pubsub.context')
+    def test_channels_route(self, _mock_context):
+        channels = core._Channels()
+        first = channels.route('project')
+        second = channels.route('project')
+        # トピックとサブスクリプションは使い回す
+        _mock_context.assert_called_once_with('project', channels.name, channels.name)
+        self.assertEqual(first.topic, second.topic)
+        self.assertNotEqual(first.task_id, second.task_id)
+        channels.close()
+
+
+class CancelTestCase(unittest.TestCase):
+    def setUp(self):
+        reload(store)
+        self.task = Task('name', 'project', Parameter(
+            instance_name='instance-{}',
+            startup_script='''
+            #!/bin/bash
+            shutdown -h now
+            ''',
+            instances=3,
+        ), fail_fast=True)
+
+    def tearDown(self):
+        core._IS_TASK_CANCELLED.clear()
+
+    @patch('gce_task_runner.core._submit_deletion')
+    def test_cancel(self, _mock_submit_deletion):
+        store.initialize(3)
+        for num in range(2):
+            instance = Mock()
+            instance.instance = 'instance-{}'.format(num)
+            store.register('xxx{}'.format(num), instance, number=num)
+        core._cancel(self.task, [])
+        # 実行中のインスタンスを全て削除する
+        self.assertEqual(['instance-0', 'instance-1'], self.task.cancelled_instances)
+        self.assertEqual(2, _mock_submit_deletion.call_count)
+        self.assertEqual(0, store.get_remains_count())
+
+    @patch('gce_task_runner.core.gce.Client')
+    def test_create_instance_cancelled(self, _mock_client):
+        store.initialize(3)
+        core._IS_TASK_CANCELLED.set()
+        core._create_instance(self.task, Mock(metas=[]), [], [], (2, [{}]))
+        # キャンセル後は作成しない
+        _mock_client.assert_not_called()
+
+    @patch('gce_task_runner.core._submit_deletion')
+    @patch('gce_task_runner.core.gce.Client')
+    def test_cancel_during_creation(self, _mock_client, _mock_submit_deletion):
+        store.initialize(3)
+        deletions = []
+        # 最初のインスタンスの作成中にエラーの通知を受け取る
+        _mock_client.return_value.create.side_effect = lambda: core._cancel(self.task, deletions)
+        core.async_run(self.task.parameter.iter_metas(),
+                       partial(core._create_instance, self.task,
+                               core._Route('project', 'topic', Mock(), 'run_id'), [], deletions),
+                       concurrency=1, sleep=0)
+        # 作成済みのインスタンスはバックグラウンドで削除し、残りは作成しない
+        _mock_client.assert_called_once()
+        _mock_client.return_value.delete.assert_not_called()
+        self.assertEqual(core._delete_instance, _mock_submit_deletion.call_args[0][0])
+        self.assertEqual(1, len(deletions))
+        self.assertEqual(['instance-0'], self.task.cancelled_instances)
+
+
+class QuotaWaitTestCase(unittest.TestCase):
+    def setUp(self):
+        reload(store)
+        store.initialize(1)
+        self.task = Task('name', 'project', Parameter(
+            instance_name='instance-{}',
+            startup_script='#!/bin/bash',
+        ))
+        self.route = core._Route('project', 'topic', Mock(), 'run_id')
+
+    def tearDown(self):
+        core._IS_TASK_CANCELLED.clear()
+        core._wait_for_deletions()
+
+    @patch('gce_task_runner.core.gce.Client')
+    def test_wait_for_any_deletion(self, _mock_client):
+        _mock_client.return_value.create.side_effect = (Exception('Quota CPUS exceeded'), None)
+        core._submit_deletion(time.sleep, 0.05)
+        core._submit_deletion(time.sleep, 2)
+        started = time.time()
+        core._create_instance(self.task, self.route, [], [], (0, [{}]))
+        # 全ての削除ではなく、いずれかの削除が終わった時点でリトライする
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(2, _mock_client.return_value.create.call_count)
+
+    def _cancel_later(self):
+        timer = threading.Timer(0.1, core._IS_TASK_CANCELLED.set)
+        timer.start()
+        return timer
+
+    @patch('gce_task_runner.core.gce.Client')
+    def test_cancel_while_waiting_for_deletion(self, _mock_client):
+        _mock_client.return_value.create.side_effect = Exception('Quota CPUS exceeded')
+        core._submit_deletion(time.sleep, 2)
+        self._cancel_later()
+        started = time.time()
+        core._create_instance(self.task, self.route, [], [], (0, [{}]))
+        # 削除の完了を待たずに中断する
+        self.assertLess(time.time() - started, 1)
+        _mock_client.return_value.create.assert_called_once_with()
+
+    @patch('gce_task_runner.core.gce.Client')
+    def test_cancel_while_retrying(self, _mock_client):
+        _mock_client.return_value.create.side_effect = Exception('Quota CPUS exceeded')
+        self.task.retry_quota_exceeded = True
+        self._cancel_later()
+        started = time.time()
+        core._create_instance(self.task, self.route, [], [], (0, [{}]))
+        # リトライまでの待機を中断する
+        self.assertLess(time.time() - started, 1)
+        _mock_client.return_value.create.assert_called_once_with()
+
+
+class BackupTestCase(unittest.TestCase):
+    def setUp(self):
+        reload(store)
+        self.task = Task('name', 'project', Parameter(
+            instance_name='instance-{}',
+            startup_script='#!/bin/bash',
+            instances=3,
+        ), retry_quota_exceeded=True, speculative_ratio=0.5)
+        self.route = core._Route('project', 'topic', Mock(), 'run_id')
+        store.initialize(3)
+
+    @patch('gce_task_runner.core.gce.Client')
+    def test_backup_error(self, _mock_client):
+        _mock_client.return_value.create.side_effect = Exception('ZONE_RESOURCE_POOL_EXHAUSTED')
+        # 複製の作成に失敗してもタスクは止めない
+        core._create_instance(self.task, self.route, [], [], (2, [{}]), backup=True)
+        with self.assertRaises(Exception):
+            core._create_instance(self.task, self.route, [], [], (2, [{}]))
+
+    @patch('gce_task_runner.core._QUOTA_RETRY_INTERVAL', 0)
+    @patch('gce_task_runner.core.gce.Client')
+    def test_backup_resolved_while_retrying(self, _mock_client):
+        store.register('xxx', Mock(), number=2)
+
+        def _create():
+            store.pop('xxx')
+            raise Exception('Quota CPUS exceeded')
+
+        _mock_client.return_value.create.side_effect = _create
+        core._create_instance(self.task, self.route, [], [], (2, [{}]), backup=True)
+        # QUOTA待ちの間に元のインスタンスが完了したらリトライしない
+        _mock_client.return_value.create.assert_called_once_with()
+
+
+@patch('gce_task_runner.core.gce.Disk')
+class DataDiskTestCase(unittest.TestCase):
+
+    def _task(self, name):
+        return Task(name, 'project', Parameter(
+            instance_name='instance-{}', startup_script='#!/bin/bash',
+            data_disks=[DataDisk('dataset', source_image='image')]))
+
+    def test_shared_data_disk(self, _mock_disk):
+        disk = _mock_disk.return_value
+        disk.project, disk.zone, disk.data_disk.name = 'project', 'asia-northeast1-b', 'dataset'
+        disks1 = core._create_data_disks(self._task('task1'))
+        disks2 = core._create_data_disks(self._task('task2'))
+        # 前のタスクのディスクをそのまま使う
+        disk.create.assert_called_once_with()
+        self.assertEqual([disk], disks2)
+
+        # 後のタスクが使用中の間は削除しない
+        core._delete_data_disks(disks1, [])
+        disk.delete.assert_not_called()
+        core._delete_data_disks(disks2, [])
+        disk.delete.assert_called_once_with()
+        self.assertEqual({}, core._DISKS)
+
+
+class ParameterTestCase(unittest.TestCase):
+
+    def _parameter(self, metas):
+        return Parameter(instance_name='instance-{}', startup_script='#!/bin/bash',
+                         instances=3, metas=metas)
+
+    def test_metas_default(self):
+        self.assertEqual([(0, [{}]), (1, [{}]), (2, [{}])],
+                         list(self._parameter(None).iter_metas()))
+
+    def test_metas_list(self):
+        metas = [[{'key': 'n', 'value': n}] for n in range(3)]
+        self.assertEqual(list(enumerate(metas)), list(self._parameter(metas).iter_metas()))
+
+    def test_metas_callable(self):
+        parameter = self._parameter(lambda n: [{'key': 'n', 'value': n}])
+        self.assertEqual([{'key': 'n', 'value': 2}], parameter.get_metas(2))
+
+    def test_metas_iterable(self):
+        consumed = []
+
+        def _metas():
+            for n in range(3):
+                consumed.append(n)
+                yield [{'key': 'n', 'value': n}]
+
+        metas = self._parameter(_metas()).iter_metas()
+        # 必要になった分だけ消費する
+        self.assertEqual((0, [{'key': 'n', 'value': 0}]), next(metas))
+        self.assertEqual([0], consumed)
+
+    def test_metas_iterable_short(self):
+        with self.assertRaises(ValueError):
+            list(self._parameter(iter([[{}]])).iter_metas())
+
+
+class ShardTestCase(unittest.TestCase):
+
+    def _task(self, project):
+        return Task('name', project, Parameter(instance_name='instance-{}',
+                                               startup_script='#!/bin/bash'))
+
+    def test_single_project(self):
+        task = self._task('project')
+        self.assertEqual(['project'], task.projects)
+        self.assertEqual('project', task.project_for(10))
+
+    def test_project_for(self):
+        task = self._task({'a': 2, 'b': 1})
+        # 完了通知は最初のプロジェクトに集める
+        self.assertEqual('a', task.project)
+        self.assertEqual(['a', 'b', 'a', 'a', 'b', 'a'], [task.project_for(n) for n in range(6)])
+
+    def test_project_for_capacity(self):
+        task = self._task({'a': 1500, 'b': 500})
+        assigned = [task.project_for(n) for n in range(2000)]
+        self.assertEqual(1500, assigned.count('a'))
+        self.assertEqual(['a', 'a', 'b', 'a'], assigned[:4])
+
+    def test_invalid_weights(self):
+        with self.assertRaises(ValueError):
+            self._task({'a': 0})
+        with self.assertRaises(ValueError):
+            self._task([])
+
+    def test_route_metas(self):
+        route = core._Route('a', 'topic', Mock(), 'run_id')
+        self.assertEqual('topic', route.metas('a')[0]['value'])
+        # 別のプロジェクトのインスタンスにはフルパスを渡す
+        self.assertEqual('projects/a/topics/topic', route.metas('b')[0]['value'])
@@ -0,0 +1,86 @@
+import unittest
+from unittest.mock import patch
+
+from gce_task_runner import gce
+
+
+def _client(**kwargs):
+    params = dict(
+        instance='instance',
+        startup_script='#!/bin/bash',
+        startup_script_url=None,
+        shutdown_script=None,
+        shutdown_script_url=None,
+        project='project',
+        zone='asia-northeast1-b',
+        machine_type='n1-standard-1',
+        image='image',
+        disk_size=20,
+        metas=[],
+        gpu_info=None,
+        minCpuPlatform=None,
+        preemptible=False,
+        labels=None,
+    )
+    params.update(kwargs)
+    return gce.Client(**params)
+
+
+@patch('gce_task_runner.gce._service')
+class DataDiskTestCase(unittest.TestCase):
+
+    def test_data_disk_source_required(self, _mock_service):
+        with self.assertRaises(ValueError):
+            gce.DataDisk('data')
+        with self.assertRaises(ValueError):
+            gce.DataDisk('data', source_snapshot='snapshot', source_image='image')
+
+    def test_disk_config(self, _mock_service):
+        disk = gce.Disk(gce.DataDisk('data', source_snapshot='global/snapshots/s', size_gb=100),
+                        'project', 'asia-northeast1-b')
+        self.assertEqual({
+            'name': 'data',
+            'type': 'projects/project/zones/asia-northeast1-b/diskTypes/pd-standard',
+            'sourceSnapshot': 'global/snapshots/s',
+            'sizeGb': 100,
+        }, disk.config)
+        self.assertEqual('projects/project/zones/asia-northeast1-b/disks/data', disk.source)
+
+    def test_disk_delete_not_created(self, _mock_service):
+        # 既存のディスクを再利用した場合は削除しない
+        disk = gce.Disk(gce.DataDisk('data', source_image='image'), 'project', 'asia-northeast1-b')
+        disk.delete()
+        _mock_service.return_value.disks.return_value.delete.assert_not_called()
+
+    def test_disk_service(self, _mock_service):
+        # スレッドごとのAPIクライアントを使う
+        disk = gce.Disk(gce.DataDisk('data', source_image='image'), 'project', 'asia-northeast1-b')
+        self.assertEqual(_mock_service.return_value, disk.service)
+
+    def test_client_config_data_disks(self, _mock_service):
+        disk = gce.Disk(gce.DataDisk('data', source_image='image', device_name='input'),
+                        'project', 'asia-northeast1-b')
+        disks = _client(data_disks=[disk]).config['disks']
+        self.assertEqual(2, len(disks))
+        self.assertTrue(disks[0]['boot'])
+        self.assertEqual({
+            'boot': False,
+            'autoDelete': False,
+            'mode': 'READ_ONLY',
+            'source': 'projects/project/zones/asia-northeast1-b/disks/data',
+            'deviceName': 'input',
+        }, disks[1])
+
+    def test_client_config_no_data_disks(self, _mock_service):
+        self.assertEqual(1, len(_client().config['disks']))
+
+
+class InstanceTestCase(unittest.TestCase):
+
+    def test_to_instance(self):
+        instance = _client().to_instance([{'key': 'a', 'value': 'b'}])
+        self.assertEqual(('instance', 'project', 'asia-northeast1-b'),
+                         (instance.instance, instance.project, instance.zone))
+        self.assertEqual([{'key': 'a', 'value': 'b'}], instance.extra_metas)
+        # 作成用のパラメータは保持しない
+        self.assertFalse(hasattr(instance, '__dict__'))
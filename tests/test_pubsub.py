@@ -0,0 +1,66 @@
+import unittest
+from unittest.mock import patch, Mock
+
+from gce_task_runner import pubsub
+
+
+@patch('gce_task_runner.pubsub.pubsub.SubscriberClient')
+class SubscribeTestCase(unittest.TestCase):
+
+    def _subscribe(self, _mock_subscriber, messages, callback, **kwargs):
+        def _subscribe(path, cb, flow_control):
+            for message in messages:
+                cb(message)
+            return Mock()
+
+        _mock_subscriber.return_value.subscribe.side_effect = _subscribe
+        client = pubsub.SubscribeClient('project')
+        client.subscribe('subscription', callback,
+                         lambda: all(m.ack.called or m.nack.called for m in messages),
+                         sleep=0.01, **kwargs)
+        return _mock_subscriber.return_value.subscribe
+
+    def test_subscribe_batch(self, _mock_subscriber):
+        messages = [Mock() for _ in range(5)]
+        batches = []
+        subscribe = self._subscribe(_mock_subscriber, messages, batches.append,
+                                    flow_control={'max_messages': 10}, max_batch_size=2)
+        # まとめて処理してからackする
+        self.assertEqual([2, 2, 1], [len(batch) for batch in batches])
+        for message in messages:
+            message.ack.assert_called_once_with()
+        self.assertEqual(10, subscribe.call_args[1]['flow_control'].max_messages)
+
+    def test_subscribe_error(self, _mock_subscriber):
+        messages = [Mock() for _ in range(2)]
+
+        def callback(batch):
+            raise Exception('error')
+
+        self._subscribe(_mock_subscriber, messages, callback)
+        # 処理に失敗したら再配信させる
+        for message in messages:
+            message.nack.assert_called_once_with()
+            message.ack.assert_not_called()
+
+    def test_subscribe_progress(self, _mock_subscriber):
+        progress = Mock()
+        self._subscribe(_mock_subscriber, [Mock()], lambda batch: None, progress=progress)
+        progress.assert_called()
+
+
+@patch('gce_task_runner.pubsub.pubsub.PublisherClient')
+class PublishTestCase(unittest.TestCase):
+
+    def test_publish(self, _mock_publisher):
+        _mock_publisher.return_value.topic_path.return_value = 'projects/project/topics/topic'
+        pubsub.PublishClient('project').publish('topic', 'xxx', task_id='task_id')
+        _mock_publisher.return_value.publish.assert_called_once_with(
+            'projects/project/topics/topic', b'xxx', task_id='task_id')
+
+    def test_publish_other_project(self, _mock_publisher):
+        pubsub.PublishClient('project').publish('projects/manager/topics/topic', 'xxx')
+        # フルパスで指定されたトピックはそのまま使う
+        _mock_publisher.return_value.topic_path.assert_not_called()
+        _mock_publisher.return_value.publish.assert_called_once_with(
+            'projects/manager/topics/topic', b'xxx')
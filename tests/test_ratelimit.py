@@ -0,0 +1,92 @@
+import unittest
+from unittest.mock import patch, Mock
+
+from googleapiclient.errors import HttpError
+
+from gce_task_runner import gce, ratelimit
+
+
+def _http_error(status, reason=''):
+    content = '{{"error": {{"errors": [{{"reason": "{}"}}]}}}}'.format(reason).encode('utf-8')
+    return HttpError(Mock(status=status, reason=reason), content)
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_acquire(self):
+        bucket = ratelimit.TokenBucket(100, capacity=2)
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0, bucket.acquire())
+        # トークンがなくなったら待機する
+        self.assertGreater(bucket.acquire(), 0)
+        stats = bucket.stats
+        self.assertEqual(3, stats['acquired'])
+        self.assertEqual(1, stats['throttled'])
+        self.assertGreater(stats['wait_seconds'], 0)
+
+
+class IsRateLimitedTestCase(unittest.TestCase):
+
+    def test_is_rate_limited(self):
+        self.assertTrue(ratelimit.is_rate_limited(_http_error(429)))
+        self.assertTrue(ratelimit.is_rate_limited(_http_error(403, 'rateLimitExceeded')))
+        self.assertTrue(ratelimit.is_rate_limited(_http_error(403, 'userRateLimitExceeded')))
+        self.assertFalse(ratelimit.is_rate_limited(_http_error(403, 'forbidden')))
+        self.assertFalse(ratelimit.is_rate_limited(_http_error(404)))
+        self.assertFalse(ratelimit.is_rate_limited(Exception()))
+
+    def test_backoff(self):
+        for attempt in range(10):
+            self.assertLessEqual(ratelimit.backoff(attempt, cap=64), min(64, 2 ** attempt))
+
+
+@patch('gce_task_runner.ratelimit.backoff', return_value=0)
+class ExecuteTestCase(unittest.TestCase):
+
+    def test_execute_retry(self, _mock_backoff):
+        request = Mock()
+        request.execute.side_effect = (_http_error(429), {'status': 'DONE'})
+        self.assertEqual({'status': 'DONE'}, gce._execute(request, 'project', write=True))
+        self.assertEqual(2, request.execute.call_count)
+
+    def test_execute_error(self, _mock_backoff):
+        request = Mock()
+        request.execute.side_effect = _http_error(404)
+        # レート制限以外のエラーはリトライしない
+        with self.assertRaises(HttpError):
+            gce._execute(request, 'project')
+        self.assertEqual(1, request.execute.call_count)
+
+
+class ProjectRateLimitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rate_limits = {k: dict(v) for k, v in gce._RATE_LIMITS.items()}
+        gce._LIMITERS.clear()
+
+    def tearDown(self):
+        gce._RATE_LIMITS.clear()
+        gce._RATE_LIMITS.update(self.rate_limits)
+        gce._LIMITERS.clear()
+
+    def test_limiter_per_project(self):
+        # プロジェクトごとに別のバケットを使う
+        self.assertIsNot(gce._limiter('a', 'read'), gce._limiter('b', 'read'))
+        self.assertIs(gce._limiter('a', 'read'), gce._limiter('a', 'read'))
+        self.assertEqual(20, gce._limiter('a', 'read').rate)
+        self.assertEqual(10, gce._limiter('a', 'write').rate)
+
+    def test_configure_rate_limits(self):
+        gce.configure_rate_limits(read=50, project='a')
+        gce.configure_rate_limits(read=30)
+        self.assertEqual(50, gce._limiter('a', 'read').rate)
+        self.assertEqual(30, gce._limiter('b', 'read').rate)
+        self.assertEqual(10, gce._limiter('a', 'write').rate)
+
+    def test_get_rate_limit_stats(self):
+        request = Mock()
+        request.execute.return_value = {}
+        gce._execute(request, 'a')
+        gce._execute(request, 'b', write=True)
+        self.assertEqual(1, gce.get_rate_limit_stats('a')['read']['acquired'])
+        self.assertEqual(['a', 'b'], sorted(gce.get_rate_limit_stats()))
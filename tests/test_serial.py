@@ -0,0 +1,111 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+from gce_task_runner import serial, store
+
+
+class _Instance:
+    def __init__(self, outputs):
+        self.instance = 'instance-0'
+        self.outputs = outputs
+        self.starts = []
+
+    def get_serial_port_output(self, start=0, port=1):
+        self.starts.append(start)
+        contents = self.outputs[start:start + 5]
+        return {'contents': contents, 'start': start, 'next': start + len(contents)}
+
+
+class SerialLogCollectorTestCase(unittest.TestCase):
+
+    def test_poll_incremental(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            collector = serial.SerialLogCollector(log_dir, min_interval=1, max_interval=8)
+            instance = _Instance('0123456789')
+            state = collector._get_state('xxx')
+            collector._poll(instance, state)
+            collector._poll(instance, state)
+            # 前回の続きから取得する
+            self.assertEqual([0, 5], instance.starts)
+            self.assertEqual(1, state.interval)
+
+            # 出力がなければ間隔を広げる
+            collector._poll(instance, state)
+            collector._poll(instance, state)
+            self.assertEqual(4, state.interval)
+            with open(os.path.join(log_dir, 'instance-0.log')) as f:
+                self.assertEqual('0123456789', f.read())
+
+    def test_capture(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            collector = serial.SerialLogCollector(log_dir)
+            instance = _Instance('tail')
+            state = collector._get_state('xxx')
+            collector.capture('xxx', instance)
+            # capture後は取得しない
+            collector._poll(instance, state)
+            self.assertEqual([0], instance.starts)
+            self.assertTrue(collector._get_state('xxx').closed)
+            with open(os.path.join(log_dir, 'instance-0.log')) as f:
+                self.assertEqual('tail', f.read())
+
+    def test_capture_timeout(self):
+        collector = serial.SerialLogCollector(capture_timeout=0.1)
+        instance = Mock()
+        instance.get_serial_port_output.side_effect = lambda **kwargs: time.sleep(1)
+        started = time.time()
+        collector.capture('xxx', instance)
+        # 取得が終わらなくても削除を待たせない
+        self.assertLess(time.time() - started, 0.5)
+
+    def test_schedule(self):
+        store.initialize(2)
+        store.register('xxx', _Instance(''))
+        collector = serial.SerialLogCollector()
+        collector._executor = Mock()
+        collector._schedule(time.time())
+        collector._schedule(time.time() + 3600)
+        # 取得待ちの間は再投入しない
+        self.assertEqual(1, collector._executor.submit.call_count)
+
+        # 出力を取得しないまま削除されたインスタンスの状態は捨てる
+        collector._get_state('yyy')
+        collector._schedule(time.time())
+        self.assertEqual(['xxx'], list(collector._states))
+        store.pop_all()
+
+    def test_fetch_error(self):
+        collector = serial.SerialLogCollector()
+        instance = Mock()
+        instance.get_serial_port_output.side_effect = Exception('not found')
+        state = collector._get_state('xxx')
+        self.assertFalse(collector._fetch(instance, state))
+        self.assertEqual(0, state.offset)
+
+    def test_schedule_captured(self):
+        store.initialize(1)
+        instance = _Instance('0123456789')
+        store.register('xxx', instance)
+        collector = serial.SerialLogCollector()
+        collector._executor = Mock()
+        get_instances = store.get_instances
+
+        def _get_instances():
+            # 一覧を取得した直後に完了通知で取り出され、削除前の出力が取得される
+            instances = get_instances()
+            store.pop('xxx')
+            collector.capture('xxx', instance)
+            return instances
+
+        with patch('gce_task_runner.serial.store.get_instances', _get_instances):
+            collector._schedule(time.time())
+        # 取得済みのインスタンスを再び収集しない
+        collector._executor.submit.assert_not_called()
+        self.assertEqual([0], instance.starts)
+
+        # 後の一覧に含まれなくなったら状態を捨てる
+        collector._schedule(time.time())
+        self.assertEqual({}, collector._states)
@@ -0,0 +1,113 @@
+import os
+import tempfile
+import unittest
+
+from gce_task_runner import simulator, trace, Parameter, Task
+
+
+class _Traces:
+    def __init__(self, profile):
+        self._profile = profile
+
+    def profile(self, parameter):
+        return self._profile
+
+
+def _task(name, instances=10, **kwargs):
+    return Task(name, 'project', Parameter(instance_name='instance-{}',
+                                           startup_script='#!/bin/bash',
+                                           machine_type='n1-standard-4',
+                                           instances=instances), **kwargs)
+
+
+class SimulateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.traces = _Traces(simulator.Profile([10], [100], [20]))
+
+    def test_simulate(self):
+        result = simulator.simulate([_task('task1', create_concurrency=5)], self.traces,
+                                    price_per_hour={'n1-standard-4': 0.2})
+        # 5台ずつ作成して、完了したものから削除する
+        self.assertEqual(120, result.task_durations['task1'])
+        self.assertEqual(140, result.makespan)
+        self.assertEqual(10, result.peak_instances)
+        self.assertEqual(40, result.peak_vcpus)
+        self.assertAlmostEqual(1200 / 3600, result.vm_hours)
+        self.assertAlmostEqual(0.2 * 1200 / 3600, result.cost)
+
+    def test_simulate_overlap(self):
+        result = simulator.simulate([_task('task1'), _task('task2')], self.traces)
+        # 前のタスクの削除を待たずに次のタスクを始める
+        self.assertEqual(110, result.task_durations['task1'])
+        self.assertEqual(240, result.makespan)
+        self.assertEqual(20, result.peak_instances)
+
+    def test_simulate_quota(self):
+        result = simulator.simulate([_task('task1'), _task('task2')], self.traces,
+                                    quota={'instances': 10})
+        # 前のタスクの削除でQUOTAが空くまで作成を待つ
+        self.assertEqual(10, result.peak_instances)
+        self.assertEqual(130, result.task_durations['task2'])
+
+    def test_simulate_quota_too_small(self):
+        with self.assertRaises(RuntimeError):
+            simulator.simulate([_task('task1')], self.traces, quota={'vcpus': 2})
+
+    def test_simulate_timeout(self):
+        traces = _Traces(simulator.Profile([10], [100], [20], preemption_rate=1.0))
+        result = simulator.simulate([_task('task1', timeout=50)], traces)
+        # プリエンプションされたインスタンスはtimeoutで削除される
+        self.assertEqual(10, result.preempted)
+        self.assertEqual(60, result.task_durations['task1'])
+        self.assertEqual(0, result.hung)
+
+    def test_dispatch_chunk(self):
+        simulation = simulator._Simulation(self.traces, {}, None, None, 0)
+        state = simulator._TaskState(_task('task1', instances=30, create_concurrency=2),
+                                     self.traces.profile(None), {'instances': 1}, 0.0, 0.0)
+        state.next_number, state.workers = 19, 2
+        simulation._dispatch(state)
+        # run()と同じくconcurrency*10台ごとに前の作成の完了を待つ
+        self.assertEqual(20, state.next_number)
+        self.assertEqual(1, state.workers)
+
+    def test_simulate_speculation(self):
+        traces = _Traces(simulator.Profile([10], [100] * 9 + [1000], [20]))
+        tasks = [_task('task1', instances=50)]
+        expected = simulator.simulate(tasks, traces, seed=1).task_durations['task1']
+        tasks = [_task('task1', instances=50, speculative_ratio=0.5)]
+        actual = simulator.simulate(tasks, traces, seed=1).task_durations['task1']
+        # 遅いインスタンスの複製が先に終わる
+        self.assertEqual(1010, expected)
+        self.assertLess(actual, expected)
+
+
+class TracesTestCase(unittest.TestCase):
+
+    def test_load_traces(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.jsonl')
+            recorder = trace.Recorder(path)
+            for _id, machine_type in (('a', 'n1-standard-4'), ('b', 'n1-standard-1')):
+                recorder.record('created', instance_id=_id, machine_type=machine_type,
+                                preemptible=False, latency=10)
+                recorder.record('completed', instance_id=_id, error=False)
+                recorder.record('deleted', instance_id=_id, latency=20)
+            recorder.record('created', instance_id='c', machine_type='n1-standard-4',
+                            preemptible=False, latency=30)
+            recorder.record('timeout', instance_id='c')
+            recorder.record('preempted', instance_id='c')
+            recorder.close()
+            traces = simulator.load_traces(path)
+
+        profile = traces.profile(_task('task1').parameter)
+        # マシンタイプが一致するトレースを使う
+        self.assertEqual([10, 30], profile.create_latency)
+        self.assertEqual(1, len(profile.runtime))
+        self.assertEqual([20], profile.delete_latency)
+        self.assertEqual(0.5, profile.preemption_rate)
+
+    def test_profile_empty(self):
+        with self.assertRaises(ValueError):
+            simulator.Profile([10], [], [20])
@@ -78,3 +78,94 @@ class GetTimeOversTestCase(unittest.TestCase):
         time.sleep(0.2)
         actual = store.get_time_overs()
         self.assertEqual(2, len(actual))
+
+
+class GetInstancesTestCase(unittest.TestCase):
+    def setUp(self):
+        reload(store)
+
+    def test_get_instances(self):
+        store.initialize(2)
+        expected_obj = object()
+        store.register('xxx', expected_obj)
+        self.assertEqual([('xxx', expected_obj)], store.get_instances())
+        # 取り出さない
+        self.assertEqual(1, len(store.get_instances()))
+
+
+class SpeculationTestCase(unittest.TestCase):
+    def setUp(self):
+        reload(store)
+
+    def test_pop_siblings(self):
+        store.initialize(2)
+        store.register('xxx', object(), number=0)
+        unspeculated_obj = object()
+        store.register('yyy', unspeculated_obj, number=1)
+        expected_obj = object()
+        store.register('xxx-spec', expected_obj, number=0)
+        self.assertEqual([(1, unspeculated_obj)], store.get_unspeculated())
+
+        # 複製が先に完了したら元のインスタンスを取り出して1台分だけ減らす
+        siblings = store.pop_siblings('xxx-spec')
+        self.assertEqual(['xxx'], [_id for _id, _ in siblings])
+        self.assertEqual(expected_obj, store.pop('xxx-spec')[0])
+        self.assertEqual(1, store.get_remains_count())
+        self.assertEqual([{'number': 0, 'instances': ['xxx', 'xxx-spec'], 'winner': 'xxx-spec'}],
+                         store.get_speculations())
+
+    def test_register_resolved(self):
+        store.initialize(1)
+        store.register('xxx', object(), number=0)
+        store.pop('xxx')
+        # 完了済みの番号は登録しない
+        self.assertFalse(store.register('xxx-spec', object(), number=0))
+        self.assertTrue(store.is_resolved(0))
+        self.assertEqual(0, store.get_remains_count())
+
+    def test_get_time_overs_with_sibling(self):
+        store.initialize(1)
+        store.register('xxx', object(), timeout=0.1, number=0)
+        store.register('xxx-spec', object(), number=0)
+        import time
+        time.sleep(0.2)
+        # 複製が実行中であれば時間切れでも完了扱いにしない
+        self.assertEqual(1, len(store.get_time_overs()))
+        self.assertEqual(1, store.get_remains_count())
+        store.pop('xxx-spec')
+        self.assertEqual(0, store.get_remains_count())
+
+
+class PopCompletionsTestCase(unittest.TestCase):
+    def setUp(self):
+        reload(store)
+
+    def test_pop_completions(self):
+        store.initialize(3)
+        expected_obj = object()
+        store.register('xxx', expected_obj, number=0)
+        store.register('yyy', object(), number=1)
+        store.register('yyy-spec', object(), number=1)
+        store.register('zzz', object(), number=2)
+        actual = store.pop_completions(['xxx', 'yyy-spec', 'unknown'])
+        self.assertEqual(('xxx', (expected_obj, None), []), actual[0])
+        self.assertEqual(['yyy'], [_id for _id, _ in actual[1][2]])
+        self.assertEqual((None, None), actual[2][1])
+        self.assertEqual(1, store.get_remains_count())
+
+
+class PopAllTestCase(unittest.TestCase):
+    def setUp(self):
+        reload(store)
+
+    def test_pop_all(self):
+        store.initialize(3)
+        store.register('xxx', object(), number=0)
+        store.register('yyy', object(), number=1)
+        self.assertEqual(['xxx', 'yyy'], [_id for _id, _ in store.pop_all()])
+        self.assertEqual(0, store.get_remains_count())
+        # 以降は格納しない
+        self.assertFalse(store.register('zzz', object(), number=2))
+
+        store.initialize(1)
+        self.assertTrue(store.register('zzz', object(), number=0))